@@ -0,0 +1,187 @@
+# advisor_runtime.py
+
+import asyncio
+import json
+import os
+import aio_pika
+import llm_router
+from advisors import ADVISORS, TASK_EXCHANGE, ALL_ADVISORS_KEY, STREAM_EXCHANGE, ADVISOR_QUEUE_ARGUMENTS
+from reliable_consumer import ConsumerMetrics, IdempotencyStore, DONE, IN_PROGRESS, declare_retry_topology_async, fail_async, defer_async
+
+ADVISOR_CONCURRENCY = int(os.getenv('ADVISOR_CONCURRENCY', 32))
+ADVISOR_BATCH_SIZE = int(os.getenv('ADVISOR_BATCH_SIZE', 1))
+ADVISOR_BATCH_WINDOW_MS = int(os.getenv('ADVISOR_BATCH_WINDOW_MS', 50))
+
+async def connect_rabbitmq():
+    return await aio_pika.connect_robust(
+        host=os.getenv('RABBITMQ_HOST'),
+        login=os.getenv('RABBITMQ_USER'),
+        password=os.getenv('RABBITMQ_PASS')
+    )
+
+async def declare_advisor_queue(channel, service):
+    queue_name = ADVISORS[service]['queue']
+    exchange = await channel.declare_exchange(TASK_EXCHANGE, aio_pika.ExchangeType.TOPIC, durable=True)
+    queue = await channel.declare_queue(queue_name, durable=True, arguments=ADVISOR_QUEUE_ARGUMENTS)
+    await queue.bind(exchange, routing_key=ALL_ADVISORS_KEY)
+    await queue.bind(exchange, routing_key=f"#.{service}.#")
+    return queue
+
+class MicroBatcher:
+    """Gathers tasks for up to `size` items or `window_ms` and answers them
+    with one multi-item provider call (llm_router.advise_batch)."""
+
+    def __init__(self, service, size, window_ms):
+        self.service = service
+        self.size = size
+        self.window = window_ms / 1000.0
+        self.queue = asyncio.Queue()
+        # Dispatches in flight, held until done (the loop keeps only weak references)
+        self.dispatches = set()
+
+    async def submit(self, content):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((content, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await self.queue.get()]
+            deadline = loop.time() + self.window
+            while len(items) < self.size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    items.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            task = asyncio.create_task(self.dispatch(items))
+            self.dispatches.add(task)
+            task.add_done_callback(self.dispatches.discard)
+
+    async def dispatch(self, items):
+        try:
+            results = await llm_router.advise_batch(self.service, [content for content, _ in items])
+        except Exception as e:
+            for _, future in items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(items, results):
+            if not future.done():
+                future.set_result(result)
+
+def idempotency_key(task, service):
+    # Scheduled replays of a task carry their own run_id so they are not
+    # mistaken for duplicates of the original request
+    key = f"{task['task_id']}:{service}"
+    return f"{key}:{task['run_id']}" if task.get('run_id') else key
+
+async def consume(service, concurrency, batch_size=ADVISOR_BATCH_SIZE):
+    advisor = ADVISORS[service]
+    connection = await connect_rabbitmq()
+    async with connection:
+        channel = await connection.channel()
+        # Never hold more unacked deliveries than we are willing to work on
+        await channel.set_qos(prefetch_count=concurrency)
+        queue = await declare_advisor_queue(channel, service)
+        dead_letter_exchange = await declare_retry_topology_async(channel, advisor['queue'])
+        await channel.declare_queue('response_queue', durable=True)
+        stream_exchange = await channel.declare_exchange(STREAM_EXCHANGE, aio_pika.ExchangeType.TOPIC, durable=True)
+
+        in_flight = asyncio.Semaphore(concurrency)
+        metrics = ConsumerMetrics(advisor['queue'])
+        idempotency = IdempotencyStore(advisor['queue'])
+
+        # The event loop only keeps weak references to tasks, so running
+        # ones are held here until they finish
+        tasks = set()
+
+        def spawn(coroutine):
+            task = asyncio.create_task(coroutine)
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        batcher = None
+        if batch_size > 1:
+            batcher = MicroBatcher(service, batch_size, ADVISOR_BATCH_WINDOW_MS)
+            spawn(batcher.run())
+
+        async def handle(message):
+            # Acked only once the response is on response_queue; failures go
+            # through the delayed retry queues and end up dead-lettered
+            key = None
+            try:
+                metrics.received(message.redelivered, message.headers)
+                try:
+                    task = json.loads(message.body)
+                    key = idempotency_key(task, service)
+                except (ValueError, KeyError) as e:
+                    await fail_async(channel, dead_letter_exchange, advisor['queue'], message, e, metrics, permanent=True)
+                    return
+                state = await idempotency.claim_async(key)
+                if state == DONE:
+                    await message.ack()
+                    metrics.record('duplicates')
+                    return
+                if state == IN_PROGRESS:
+                    # Another attempt holds the key, possibly one that crashed
+                    key = None
+                    await defer_async(channel, advisor['queue'], message, metrics)
+                    return
+
+                print(f"{advisor['title']} processing task: {task['content']}")
+                emit = None
+                if task.get('stream'):
+                    sequence = 0
+
+                    async def emit(event):
+                        nonlocal sequence
+                        sequence += 1
+                        event = dict(event, task_id=task['task_id'], service=service, seq=sequence)
+                        await stream_exchange.publish(
+                            aio_pika.Message(body=json.dumps(event).encode('utf-8')),
+                            routing_key=f"{task['task_id']}.{service}"
+                        )
+                if batcher is not None and emit is None:
+                    content = await batcher.submit(task['content'])
+                else:
+                    content = await llm_router.advise(service, task['content'], emit)
+                if emit is not None:
+                    await emit({'type': 'done', 'content': content})
+                response_data = {
+                    'user_id': task['user_id'],
+                    'task_id': task['task_id'],
+                    'run_id': task.get('run_id'),
+                    'service': service,
+                    'advisors': task.get('advisors'),
+                    'content': content
+                }
+                await channel.default_exchange.publish(
+                    aio_pika.Message(body=json.dumps(response_data).encode('utf-8'), delivery_mode=aio_pika.DeliveryMode.PERSISTENT),
+                    routing_key='response_queue'
+                )
+                await idempotency.complete_async(key)
+                await message.ack()
+                metrics.record('acked')
+            except Exception as e:
+                print(f"{advisor['title']} failed to process message: {str(e)}")
+                await idempotency.release_async(key)
+                try:
+                    await fail_async(channel, dead_letter_exchange, advisor['queue'], message, e, metrics)
+                except Exception as retry_error:
+                    # Leave it unacked; the broker redelivers it when the channel closes
+                    print(f"{advisor['title']} could not schedule a retry: {str(retry_error)}")
+            finally:
+                in_flight.release()
+
+        print(f"{advisor['title']} waiting for messages...")
+        async with queue.iterator() as messages:
+            async for message in messages:
+                await in_flight.acquire()
+                spawn(handle(message))
+
+def run_advisor(service, concurrency=None):
+    asyncio.run(consume(service, concurrency or ADVISOR_CONCURRENCY))
@@ -0,0 +1,128 @@
+# advisors.py
+
+# Topic exchange every advisor queue is bound to. A task is published once
+# with a routing key naming the advisors it wants ("all" for every advisor),
+# e.g. "focus_techniques.task_breakdown".
+TASK_EXCHANGE = 'advisor_tasks'
+ALL_ADVISORS_KEY = 'all'
+
+# Topic exchange carrying incremental advisor output for streaming clients,
+# routed by "<task_id>.<service>". The gateway binds a short-lived
+# stream.<task_id> queue to it for each task a client wants to stream.
+STREAM_EXCHANGE = 'advisor_stream'
+
+# Advisor queues are priority queues so interactive /task requests are
+# delivered ahead of scheduler-triggered replays. Changing queue arguments
+# requires the existing queues to be deleted before the new declaration.
+ADVISOR_QUEUE_ARGUMENTS = {'x-max-priority': 10}
+PRIORITY_INTERACTIVE = 9
+PRIORITY_BACKGROUND = 1
+
+# Prompt and routing definitions shared by main-app, the advisor microservices
+# and the API gateway, so every caller agrees on what a given task will be
+# asked. Each advisor names a capability route: the preferred provider/model
+# first, then the fallbacks llm_router may hedge or fail over to. Prompts are
+# provider-neutral; llm_providers adapts them to each vendor's API. Advisors
+# without max_tokens are uncapped, as they were on gpt-4 before routing: they
+# get the provider's whole output limit on whichever route serves them.
+CLAUDE_MODEL = 'claude-3-sonnet-20240229'
+
+ADVISORS = {
+    'task_breakdown': {
+        'title': 'Task Breakdown Service',
+        'queue': 'task_breakdown_queue',
+        'routes': [('openai', 'gpt-4'), ('anthropic', CLAUDE_MODEL), ('google', 'gemini-pro')],
+        'split_lines': True,
+        'system': "You are a helpful assistant that breaks down tasks for people with ADHD.",
+        'prompt': "Break down this task into manageable steps: {content}"
+    },
+    'time_management': {
+        'title': 'Time Management Service',
+        'queue': 'time_management_queue',
+        'routes': [('anthropic', CLAUDE_MODEL), ('openai', 'gpt-4'), ('google', 'gemini-pro')],
+        'max_tokens': 300,
+        'system': None,
+        'prompt': "Provide a time management strategy for the following task: {content}"
+    },
+    'focus_techniques': {
+        'title': 'Focus Techniques Service',
+        'queue': 'focus_techniques_queue',
+        'routes': [('google', 'gemini-pro'), ('openai', 'gpt-4'), ('anthropic', CLAUDE_MODEL)],
+        'max_tokens': 300,
+        'system': None,
+        'prompt': "Suggest focus techniques for someone with ADHD to complete this task: {content}"
+    },
+    'learning_strategies': {
+        'title': 'Learning Strategies Service',
+        'queue': 'learning_strategies_queue',
+        'routes': [('openai', 'gpt-4'), ('anthropic', CLAUDE_MODEL), ('google', 'gemini-pro')],
+        'system': "You are a helpful assistant that provides learning strategies for people with ADHD.",
+        'prompt': "Suggest learning strategies for someone with ADHD to learn about: {content}"
+    },
+    'emotional_regulation': {
+        'title': 'Emotional Regulation Service',
+        'queue': 'emotional_regulation_queue',
+        'routes': [('anthropic', CLAUDE_MODEL), ('openai', 'gpt-4'), ('google', 'gemini-pro')],
+        'max_tokens': 300,
+        'system': None,
+        'prompt': "Suggest emotional regulation strategies for someone with ADHD dealing with: {content}"
+    }
+}
+
+# One structured request that answers every advisor at once, used by
+# main-app's combined mode for short tasks.
+COMBINED_ADVISOR = {
+    'routes': [('openai', 'gpt-4'), ('anthropic', CLAUDE_MODEL), ('google', 'gemini-pro')],
+    'max_tokens': 1500,
+    'system': "You are a helpful assistant that supports people with ADHD."
+}
+
+def build_prompt(service, content):
+    return ADVISORS[service]['prompt'].format(content=content)
+
+def primary_route(service):
+    return ADVISORS[service]['routes'][0]
+
+def cache_prompt(service, content):
+    # The system prompt changes the answer, so it is part of the cache key
+    advisor = ADVISORS[service]
+    return f"{advisor['system'] or ''}\n{build_prompt(service, content)}"
+
+def build_combined_prompt(content):
+    sections = []
+    for service, advisor in ADVISORS.items():
+        shape = 'a JSON array of strings, one step per element' if advisor.get('split_lines') else 'a string'
+        sections.append(f"- \"{service}\" ({shape}): {advisor['prompt'].format(content='the task')}")
+    return (
+        f"Task: {content}\n\n"
+        "Respond with only a JSON object with exactly these keys:\n" + '\n'.join(sections)
+    )
+
+def postprocess(service, text):
+    text = text.strip()
+    if ADVISORS[service].get('split_lines'):
+        return text.split('\n')
+    return text
+
+def routing_key_for(services=None):
+    if not services:
+        return ALL_ADVISORS_KEY
+    return '.'.join(sorted(services))
+
+def declare_task_exchange(channel):
+    channel.exchange_declare(exchange=TASK_EXCHANGE, exchange_type='topic', durable=True)
+
+def declare_stream_exchange(channel):
+    channel.exchange_declare(exchange=STREAM_EXCHANGE, exchange_type='topic', durable=True)
+
+def stream_queue_name(task_id):
+    return f"stream.{task_id}"
+
+def declare_advisor_queue(channel, service):
+    # New advisors only need to bind themselves here; the gateway does not
+    # have to know about them to reach them with the "all" key.
+    queue = ADVISORS[service]['queue']
+    declare_task_exchange(channel)
+    channel.queue_declare(queue=queue, durable=True, arguments=ADVISOR_QUEUE_ARGUMENTS)
+    channel.queue_bind(queue=queue, exchange=TASK_EXCHANGE, routing_key=ALL_ADVISORS_KEY)
+    channel.queue_bind(queue=queue, exchange=TASK_EXCHANGE, routing_key=f"#.{service}.#")
@@ -1,105 +1,318 @@
 # Microservices/APIGateway.py
 
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, make_response
 import pika
 import os
 import json
-import jwt
+import math
+import time
+import uuid
+from auth import token_required
 from functools import wraps
 import redis
+import llm_cache
+from llm_router import lookup_advice
+from advisors import ADVISORS, TASK_EXCHANGE, STREAM_EXCHANGE, PRIORITY_INTERACTIVE, routing_key_for, declare_advisor_queue, declare_stream_exchange, stream_queue_name
+from rabbitmq_pool import PublisherPool, connection_parameters
+from ttl_cache import TTLCache
+from hasura_client import HasuraClient
 
 app = Flask(__name__)
 
 # Setup Redis for rate limiting
 redis_client = redis.Redis(host=os.getenv('REDIS_HOST', 'localhost'), port=6379, db=0)
+llm_cache.use_redis(redis_client)
 
-def connect_rabbitmq():
-    credentials = pika.PlainCredentials(os.getenv('RABBITMQ_USER'), os.getenv('RABBITMQ_PASS'))
-    connection = pika.BlockingConnection(pika.ConnectionParameters(host=os.getenv('RABBITMQ_HOST'), credentials=credentials))
-    return connection
-
-def token_required(f):
-    @wraps(f)
-    def decorated(*args, **kwargs):
-        token = request.headers.get('Authorization')
-        if not token:
-            return jsonify({'message': 'Token is missing!'}), 401
-        try:
-            data = jwt.decode(token, os.getenv('JWT_SECRET'), algorithms=["HS256"])
-        except:
-            return jsonify({'message': 'Token is invalid!'}), 401
-        return f(*args, **kwargs)
-    return decorated
+hasura = HasuraClient()
+
+RESULT_WAIT_MAX = float(os.getenv('RESULT_WAIT_MAX', 30))
+STREAM_MAX_SECONDS = float(os.getenv('STREAM_MAX_SECONDS', 120))
+# A stream queue nobody consumes from deletes itself after this long
+STREAM_QUEUE_TTL_MS = int(os.getenv('STREAM_QUEUE_TTL_MS', 60000))
+TASK_OWNER_TTL = int(os.getenv('TASK_RESULT_TTL', 86400))
+
+def declare_advisor_topology(channel):
+    for service in ADVISORS:
+        declare_advisor_queue(channel, service)
+    declare_stream_exchange(channel)
+
+# Long-lived RabbitMQ publishers shared by all request threads
+publisher = PublisherPool(queues=['response_queue'], topology=declare_advisor_topology)
+
+# Token bucket refilled continuously at limit/per tokens per second. Reading,
+# refilling and spending a token happen atomically in one round-trip.
+RATE_LIMIT_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local refill_per_ms = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1])
+local ts = tonumber(bucket[2])
+if tokens == nil then
+  tokens = capacity
+  ts = now
+end
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * refill_per_ms)
+local allowed = 0
+local retry_ms = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+  allowed = 1
+else
+  retry_ms = math.ceil((1 - tokens) / refill_per_ms)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / refill_per_ms))
+return {allowed, math.floor(tokens), retry_ms, math.ceil((capacity - tokens) / refill_per_ms)}
+"""
+rate_limit_script = redis_client.register_script(RATE_LIMIT_SCRIPT)
+
+# Clients Redis has already rejected are turned away locally until their next
+# token is due, without another Redis call. RATE_LIMIT_LOCAL=0 turns this off
+# so every request is decided by Redis.
+RATE_LIMIT_LOCAL = os.getenv('RATE_LIMIT_LOCAL', '1') != '0'
+rate_limit_blocked = TTLCache(maxsize=int(os.getenv('RATE_LIMIT_LOCAL_SIZE', 10000)))
+
+def rate_limit_headers(response, limit, remaining, reset_ms):
+    response.headers['X-RateLimit-Limit'] = str(limit)
+    response.headers['X-RateLimit-Remaining'] = str(remaining)
+    response.headers['X-RateLimit-Reset'] = str(math.ceil(reset_ms / 1000))
+    return response
+
+def rate_limit_exceeded(limit, retry_ms, reset_ms):
+    response = make_response(jsonify({'message': 'Rate limit exceeded!'}), 429)
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_ms / 1000)))
+    return rate_limit_headers(response, limit, 0, reset_ms)
 
 def rate_limit(limit=100, per=60):
+    refill_per_ms = limit / (per * 1000.0)
+
+    # Goes below token_required: buckets are keyed on the verified user_id it
+    # passes as the first argument, never on anything the client chooses
     def decorator(f):
         @wraps(f)
-        def decorated(*args, **kwargs):
-            user_id = request.headers.get('User-ID')
-            if not user_id:
-                return jsonify({'message': 'User ID is missing!'}), 400
-            
-            key = f"rate_limit:{user_id}"
-            count = redis_client.get(key)
-            
-            if count is None:
-                redis_client.set(key, 1, ex=per)
-            elif int(count) >= limit:
-                return jsonify({'message': 'Rate limit exceeded!'}), 429
-            else:
-                redis_client.incr(key)
-            
-            return f(*args, **kwargs)
+        def decorated(user_id, *args, **kwargs):
+            # Buckets are per route, so each endpoint can carry its own limit
+            key = f"rate_limit:{f.__name__}:{user_id}"
+            blocked_until = rate_limit_blocked.get(key) if RATE_LIMIT_LOCAL else None
+            if blocked_until is not None:
+                retry_ms = max(0, (blocked_until - time.monotonic()) * 1000)
+                return rate_limit_exceeded(limit, retry_ms, retry_ms)
+
+            try:
+                allowed, remaining, retry_ms, reset_ms = rate_limit_script(
+                    keys=[key], args=[limit, refill_per_ms, int(time.time() * 1000)]
+                )
+            except redis.RedisError as e:
+                # Fail open: an unavailable limiter should not take the API down
+                print(f"Rate limiter unavailable: {str(e)}")
+                return f(user_id, *args, **kwargs)
+
+            if not allowed:
+                if RATE_LIMIT_LOCAL:
+                    rate_limit_blocked.set(key, time.monotonic() + retry_ms / 1000.0, ttl=retry_ms / 1000.0)
+                return rate_limit_exceeded(limit, retry_ms, reset_ms)
+
+            response = make_response(f(user_id, *args, **kwargs))
+            return rate_limit_headers(response, limit, remaining, reset_ms)
         return decorated
     return decorator
 
 @app.route('/task', methods=['POST'])
 @token_required
 @rate_limit()
-def create_task():
+def create_task(user_id):
     data = request.json
     if not data or 'content' not in data:
         return jsonify({'message': 'Invalid request'}), 400
 
+    requested = data.get('advisors') or list(ADVISORS)
+    if not isinstance(requested, list):
+        return jsonify({'message': 'advisors must be a list'}), 400
+    unknown = [service for service in requested if service not in ADVISORS]
+    if unknown:
+        return jsonify({'message': 'Unknown advisors', 'advisors': unknown}), 400
+
     task = {
-        'user_id': request.headers.get('User-ID'),
+        'user_id': user_id,
         'task_id': str(uuid.uuid4()),
-        'content': data['content']
+        'content': data['content'],
+        'advisors': requested,
+        'stream': bool(data.get('stream'))
     }
 
-    connection = connect_rabbitmq()
-    channel = connection.channel()
+    # Lets the result endpoints check ownership before the result exists
+    redis_client.set(f"task_owner:{task['task_id']}", user_id, ex=TASK_OWNER_TTL)
 
-    # Publish to all relevant queues
-    queues = ['task_breakdown_queue', 'time_management_queue', 'focus_techniques_queue', 
-              'learning_strategies_queue', 'emotional_regulation_queue']
-    
-    for queue in queues:
-        channel.queue_declare(queue=queue)
-        channel.basic_publish(exchange='', routing_key=queue, body=json.dumps(task))
+    # Bind the task's stream queue before any advisor can start producing, so
+    # a client that opens the stream after this request returns misses nothing.
+    if task['stream']:
+        queue = stream_queue_name(task['task_id'])
+        with publisher.channel() as channel:
+            channel.queue_declare(queue=queue, arguments={'x-expires': STREAM_QUEUE_TTL_MS})
+            channel.queue_bind(queue=queue, exchange=STREAM_EXCHANGE, routing_key=f"{task['task_id']}.#")
 
-    connection.close()
+    # Advisors whose answer is already cached skip their queue and the LLM call
+    # entirely; the cached answer goes straight to the aggregator.
+    uncached = []
+    for service in requested:
+        cached = lookup_advice(service, task['content'])
+        if cached is not None:
+            response_data = {
+                'user_id': task['user_id'],
+                'task_id': task['task_id'],
+                'service': service,
+                'advisors': requested,
+                'content': cached
+            }
+            publisher.publish('', 'response_queue', json.dumps(response_data), pika.BasicProperties(delivery_mode=2))
+            if task['stream']:
+                event = {'type': 'done', 'task_id': task['task_id'], 'service': service, 'seq': 1, 'content': cached}
+                publisher.publish(STREAM_EXCHANGE, f"{task['task_id']}.{service}", json.dumps(event))
+        else:
+            uncached.append(service)
+
+    # One publish reaches every remaining advisor through the topic exchange
+    if uncached:
+        routing_key = routing_key_for(None if len(uncached) == len(ADVISORS) else uncached)
+        publisher.publish(TASK_EXCHANGE, routing_key, json.dumps(task), pika.BasicProperties(priority=PRIORITY_INTERACTIVE, delivery_mode=2))
 
     return jsonify({'message': 'Task created successfully', 'task_id': task['task_id']}), 201
 
+def lookup_task_result(task_id):
+    # The aggregator writes assembled results to Redis; Hasura is the fallback
+    # once the Redis copy has expired.
+    cached = redis_client.get(f"task_result:{task_id}")
+    if cached is not None:
+        return json.loads(cached)
+
+    task_result = hasura.execute_operation('TaskResult', {'task_id': task_id})['data']['task_results_by_pk']
+    if task_result and isinstance(task_result['results'], str):
+        task_result['results'] = json.loads(task_result['results'])
+    return task_result
+
+def wait_for_task_result(task_id, timeout):
+    pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(f"task_result:{task_id}")
+    try:
+        # Re-check after subscribing so a result published in between is not missed
+        task_result = lookup_task_result(task_id)
+        deadline = time.monotonic() + timeout
+        while task_result is None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            message = pubsub.get_message(timeout=remaining)
+            if message is not None:
+                task_result = json.loads(message['data'])
+        return task_result
+    finally:
+        pubsub.close()
+
+def pending_result(task_id):
+    return {'task_id': task_id, 'status': 'pending'}
+
+def task_owner(task_id, task_result=None):
+    # The assembled result names its owner; until it exists, create_task's record does
+    if task_result is not None:
+        return task_result['user_id']
+    owner = redis_client.get(f"task_owner:{task_id}")
+    return owner.decode('utf-8') if owner is not None else None
+
+def not_owner(task_id, user_id, task_result=None):
+    # Someone else's task is reported exactly like a missing one
+    owner = task_owner(task_id, task_result)
+    return owner is not None and owner != user_id
+
+def task_not_found():
+    return jsonify({'message': 'Task not found'}), 404
+
 @app.route('/results/<task_id>', methods=['GET'])
 @token_required
-@rate_limit()
-def get_results(task_id):
-    # Here you would query your database (e.g., via Hasura) to get the aggregated results
-    # This is a placeholder implementation
-    results = {
-        'task_id': task_id,
-        'status': 'completed',
-        'results': {
-            'task_breakdown': ['Step 1', 'Step 2', 'Step 3'],
-            'time_management': 'Use Pomodoro technique',
-            'focus_techniques': 'Use noise-cancelling headphones',
-            'learning_strategies': 'Create mind maps',
-            'emotional_regulation': 'Practice deep breathing'
-        }
-    }
-    return jsonify(results), 200
+@rate_limit(limit=300, per=60)
+def get_results(user_id, task_id):
+    if not_owner(task_id, user_id):
+        return task_not_found()
+    # ?wait=N long-polls for up to N seconds instead of answering "pending" at once
+    wait = min(request.args.get('wait', 0, type=float), RESULT_WAIT_MAX)
+    if wait > 0:
+        task_result = wait_for_task_result(task_id, wait)
+    else:
+        task_result = lookup_task_result(task_id)
+
+    if task_result is None:
+        return jsonify(pending_result(task_id)), 202
+    if not_owner(task_id, user_id, task_result):
+        return task_not_found()
+    return jsonify(task_result), 200
+
+@app.route('/results/<task_id>/events', methods=['GET'])
+@token_required
+@rate_limit(limit=300, per=60)
+def stream_results(user_id, task_id):
+    if not_owner(task_id, user_id):
+        return task_not_found()
+
+    def events():
+        task_result = None
+        deadline = time.monotonic() + RESULT_WAIT_MAX
+        while task_result is None and time.monotonic() < deadline:
+            task_result = wait_for_task_result(task_id, min(15, deadline - time.monotonic()))
+            if task_result is None:
+                yield ": keep-alive\n\n"
+        if task_result is None:
+            yield f"event: pending\ndata: {json.dumps(pending_result(task_id))}\n\n"
+        elif not_owner(task_id, user_id, task_result):
+            yield f"event: error\ndata: {json.dumps({'message': 'Task not found'})}\n\n"
+        else:
+            yield f"event: result\ndata: {json.dumps(task_result)}\n\n"
+
+    return Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+@app.route('/results/<task_id>/stream', methods=['GET'])
+@token_required
+@rate_limit(limit=300, per=60)
+def stream_task(user_id, task_id):
+    # Relays advisor output for a task created with "stream": true as
+    # Server-Sent Events: "chunk" events with text deltas, one "done" event
+    # per advisor, then the assembled "result" once the aggregator has it.
+    # Every streamed task has an owner record, so an unknown owner is refused
+    # too, before anything is subscribed to.
+    if task_owner(task_id) != user_id:
+        return task_not_found()
+    connection = pika.BlockingConnection(connection_parameters())
+    channel = connection.channel()
+    try:
+        channel.queue_declare(queue=stream_queue_name(task_id), passive=True)
+    except pika.exceptions.ChannelClosedByBroker:
+        connection.close()
+        return jsonify({'message': 'No stream for this task'}), 404
+
+    def events():
+        deadline = time.monotonic() + STREAM_MAX_SECONDS
+        try:
+            for method, properties, body in channel.consume(stream_queue_name(task_id), auto_ack=True, inactivity_timeout=1):
+                if method is not None:
+                    event = json.loads(body)
+                    yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+                    continue
+
+                task_result = redis_client.get(f"task_result:{task_id}")
+                if task_result is not None:
+                    yield f"event: result\ndata: {task_result.decode('utf-8')}\n\n"
+                    return
+                if time.monotonic() >= deadline:
+                    yield f"event: pending\ndata: {json.dumps(pending_result(task_id))}\n\n"
+                    return
+                yield ": keep-alive\n\n"
+        finally:
+            try:
+                channel.cancel()
+                connection.close()
+            except Exception:
+                pass
+
+    return Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=3000)
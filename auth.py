@@ -0,0 +1,68 @@
+# auth.py
+
+import hashlib
+import os
+import time
+from functools import wraps
+from flask import request, jsonify
+import jwt
+from ttl_cache import TTLCache
+
+# Read once at startup rather than on every request
+JWT_SECRET = os.getenv('JWT_SECRET')
+
+# sha256(token) -> verified claims. Entries never outlive the token's exp.
+token_cache = TTLCache(
+    maxsize=int(os.getenv('JWT_CACHE_SIZE', 10000)),
+    ttl=int(os.getenv('JWT_CACHE_TTL', 300))
+)
+verify_stats = {'verifications': 0, 'failures': 0, 'verify_seconds': 0.0}
+
+def configure(secret):
+    global JWT_SECRET
+    JWT_SECRET = secret
+    token_cache.clear()
+
+def decode_token(token):
+    digest = hashlib.sha256(token.encode('utf-8')).hexdigest()
+    claims = token_cache.get(digest)
+    if claims is not None:
+        return claims
+
+    start = time.perf_counter()
+    try:
+        claims = jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
+    except Exception:
+        verify_stats['failures'] += 1
+        raise
+    finally:
+        verify_stats['verifications'] += 1
+        verify_stats['verify_seconds'] += time.perf_counter() - start
+
+    ttl = token_cache.ttl
+    if 'exp' in claims:
+        ttl = min(ttl, claims['exp'] - time.time())
+    token_cache.set(digest, claims, ttl=ttl)
+    return claims
+
+def token_required(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        token = request.headers.get('Authorization')
+        if not token:
+            return jsonify({'message': 'Token is missing!'}), 401
+        try:
+            data = decode_token(token)
+        except Exception:
+            return jsonify({'message': 'Token is invalid!'}), 401
+        return f(data['user_id'], *args, **kwargs)
+    return decorated
+
+def stats():
+    verifications = verify_stats['verifications']
+    return {
+        'cache': token_cache.stats(),
+        'verifications': verifications,
+        'failures': verify_stats['failures'],
+        'avg_verify_ms': (verify_stats['verify_seconds'] / verifications * 1000) if verifications else 0.0
+    }
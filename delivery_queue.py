@@ -0,0 +1,127 @@
+# delivery_queue.py
+
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from ttl_cache import TTLCache, MISSING
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+QUEUED = 'queued'
+SENDING = 'sending'
+SENT = 'sent'
+FAILED = 'failed'
+
+def connect_redis():
+    host = os.getenv('DELIVERY_STATUS_REDIS_HOST', os.getenv('REDIS_HOST'))
+    if redis is None or not host:
+        return None
+    return redis.Redis(host=host, port=int(os.getenv('REDIS_PORT', 6379)), db=0, socket_timeout=0.25)
+
+class DeliveryQueue:
+    """Bounded in-process queue drained by a fixed pool of worker threads.
+
+    `submit` never blocks the caller: it returns a delivery id immediately,
+    or raises queue.Full when the backlog is at `maxsize` so the caller can
+    push back. Workers take up to `batch_size` items at a time and hand them
+    to `handler(payloads)`, which returns one entry per payload: None on
+    success or the error. Delivery status is kept for `status_ttl` seconds,
+    in Redis when REDIS_HOST is set so that any worker or replica can answer
+    for it, and in a local TTL cache as well (the only copy without Redis,
+    in which case status is only visible to the process that queued it).
+    """
+
+    def __init__(self, handler, workers=4, maxsize=1000, batch_size=20, status_ttl=3600, name='delivery', redis_client=MISSING):
+        self.handler = handler
+        self.batch_size = batch_size
+        self.name = name
+        self.status_ttl = status_ttl
+        self.redis = connect_redis() if redis_client is MISSING else redis_client
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._statuses = TTLCache(maxsize=max(maxsize * 10, 1024), ttl=status_ttl)
+        self.counts = {'submitted': 0, 'rejected': 0, 'sent': 0, 'failed': 0}
+        for i in range(workers):
+            threading.Thread(target=self._work, name=f"{name}-{i}", daemon=True).start()
+
+    def submit(self, payload, owner=None):
+        delivery_id = str(uuid.uuid4())
+        # Recorded before enqueueing so a worker never updates a missing entry
+        self._store(delivery_id, {'id': delivery_id, 'owner': owner, 'status': QUEUED, 'queued_at': time.time()})
+        try:
+            self._queue.put_nowait((delivery_id, payload))
+        except queue.Full:
+            self._discard(delivery_id)
+            self.counts['rejected'] += 1
+            raise
+        self.counts['submitted'] += 1
+        return delivery_id
+
+    def _key(self, delivery_id):
+        return f"{self.name}_delivery:{delivery_id}"
+
+    def _store(self, delivery_id, status):
+        self._statuses.set(delivery_id, status)
+        if self.redis is not None:
+            try:
+                self.redis.set(self._key(delivery_id), json.dumps(status), ex=self.status_ttl)
+            except redis.RedisError as e:
+                print(f"{self.name} status write failed: {str(e)}")
+
+    def _discard(self, delivery_id):
+        self._statuses.pop(delivery_id)
+        if self.redis is not None:
+            try:
+                self.redis.delete(self._key(delivery_id))
+            except redis.RedisError as e:
+                print(f"{self.name} status delete failed: {str(e)}")
+
+    def status(self, delivery_id):
+        if self.redis is not None:
+            try:
+                status = self.redis.get(self._key(delivery_id))
+                if status is not None:
+                    return json.loads(status)
+            except redis.RedisError as e:
+                print(f"{self.name} status lookup failed: {str(e)}")
+        return self._statuses.get(delivery_id)
+
+    def _update(self, delivery_id, **fields):
+        # Only the worker holding a delivery updates it, so the local copy
+        # is current and there is no read-modify-write race
+        status = self._statuses.get(delivery_id)
+        if status is not None:
+            self._store(delivery_id, dict(status, **fields))
+
+    def _work(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            for delivery_id, _ in batch:
+                self._update(delivery_id, status=SENDING)
+            try:
+                errors = self.handler([payload for _, payload in batch])
+            except Exception as e:
+                errors = [e] * len(batch)
+            for (delivery_id, _), error in zip(batch, errors):
+                if error is None:
+                    self.counts['sent'] += 1
+                    self._update(delivery_id, status=SENT, finished_at=time.time())
+                else:
+                    self.counts['failed'] += 1
+                    print(f"{self.name} {delivery_id} failed: {str(error)}")
+                    self._update(delivery_id, status=FAILED, error=str(error), finished_at=time.time())
+            for _ in batch:
+                self._queue.task_done()
+
+    def stats(self):
+        return dict(self.counts, backlog=self._queue.qsize(), capacity=self._queue.maxsize)
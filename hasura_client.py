@@ -0,0 +1,116 @@
+# hasura_client.py
+
+import os
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from hasura_operations import get_operation
+
+class HasuraClient:
+    """GraphQL client for Hasura that keeps pooled keep-alive connections.
+
+    Connection failures are retried with exponential backoff, and so are
+    502/503/504 responses to queries. Mutations are not retried on those:
+    a gateway error does not mean the write failed, so resending could
+    apply it twice. Latency is recorded per operation name.
+
+    Registered operations (hasura_operations) are sent according to
+    HASURA_OPERATION_MODE: "document" sends the full text and "rest" calls
+    the operation's Hasura REST endpoint. Hasura does not implement
+    automatic persisted queries, so there is no hash-only mode; "rest" is
+    the way to keep documents off the wire.
+    """
+
+    MODES = ('document', 'rest')
+
+    def __init__(self, endpoint=None, admin_secret=None, pool_size=None, timeout=None, retries=None, backoff=None, mode=None):
+        self.endpoint = endpoint or os.getenv('HASURA_GRAPHQL_ENDPOINT')
+        self.mode = mode or os.getenv('HASURA_OPERATION_MODE', 'document')
+        if self.mode not in self.MODES:
+            raise ValueError(f"HASURA_OPERATION_MODE must be one of {', '.join(self.MODES)}, not {self.mode}")
+        self.rest_endpoint = os.getenv('HASURA_REST_ENDPOINT') or self.endpoint.rsplit('/v1/graphql', 1)[0] + '/api/rest'
+        self.timeout = timeout or float(os.getenv('HASURA_TIMEOUT', 10))
+        pool_size = pool_size or int(os.getenv('HASURA_POOL_SIZE', 20))
+        retries = int(os.getenv('HASURA_RETRIES', 3)) if retries is None else retries
+        backoff = float(os.getenv('HASURA_RETRY_BACKOFF', 0.2)) if backoff is None else backoff
+
+        headers = {
+            'Content-Type': 'application/json',
+            'X-Hasura-Admin-Secret': admin_secret or os.getenv('HASURA_ADMIN_SECRET')
+        }
+        self.session = self._session(headers, pool_size, Retry(
+            total=retries,
+            connect=retries,
+            read=0,
+            status=retries,
+            backoff_factor=backoff,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(['POST']),
+            raise_on_status=False
+        ))
+        # Only requests that never reached Hasura are resent
+        self.write_session = self._session(headers, pool_size, Retry(
+            total=retries,
+            connect=retries,
+            read=0,
+            status=0,
+            other=0,
+            backoff_factor=backoff,
+            allowed_methods=frozenset(['POST']),
+            raise_on_status=False
+        ))
+
+        self._metrics = {}
+        self._metrics_lock = threading.Lock()
+
+    def _session(self, headers, pool_size, retry):
+        session = requests.Session()
+        session.headers.update(headers)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def _post(self, url, payload, operation, retry_safe=True):
+        start = time.perf_counter()
+        failed = True
+        session = self.session if retry_safe else self.write_session
+        try:
+            response = session.post(url, json=payload, timeout=self.timeout)
+            response.raise_for_status()
+            result = response.json()
+            failed = bool(result.get('errors'))
+            return result
+        finally:
+            self._record(operation, time.perf_counter() - start, failed)
+
+    def execute(self, query, variables=None, operation='anonymous'):
+        retry_safe = not query.lstrip().startswith('mutation')
+        return self._post(self.endpoint, {'query': query, 'variables': variables}, operation, retry_safe)
+
+    def execute_operation(self, name, variables=None):
+        op = get_operation(name)
+        if self.mode == 'rest':
+            # REST endpoints answer with the bare data object
+            return {'data': self._post(f"{self.rest_endpoint}/{op.rest_path}", variables or {}, name, op.retry_safe)}
+
+        payload = {'operationName': op.name, 'query': op.document, 'variables': variables}
+        return self._post(self.endpoint, payload, name, op.retry_safe)
+
+    def _record(self, operation, elapsed, failed):
+        with self._metrics_lock:
+            metric = self._metrics.setdefault(operation, {'count': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+            elapsed_ms = elapsed * 1000
+            metric['count'] += 1
+            metric['errors'] += int(failed)
+            metric['total_ms'] += elapsed_ms
+            metric['max_ms'] = max(metric['max_ms'], elapsed_ms)
+
+    def metrics(self):
+        with self._metrics_lock:
+            return {
+                operation: dict(metric, avg_ms=metric['total_ms'] / metric['count'])
+                for operation, metric in self._metrics.items()
+            }
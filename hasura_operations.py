@@ -0,0 +1,170 @@
+# hasura_operations.py
+
+import json
+import re
+import sys
+
+# Every GraphQL document the services send to Hasura, by operation name.
+# Call sites refer to operations by name; depending on HASURA_OPERATION_MODE
+# the client sends the full document or calls the matching Hasura REST
+# endpoint (see rest_metadata below).
+DOCUMENTS = {
+    'CreateUser': """
+    mutation CreateUser($email: String!, $password: String!) {
+      insert_users_one(object: {email: $email, password: $password}) {
+        id
+      }
+    }
+    """,
+    'InsertUser': """
+    mutation InsertUser($id: uuid!, $email: String!, $password: String!) {
+      insert_users_one(object: {id: $id, email: $email, password: $password}, on_conflict: {constraint: users_email_key, update_columns: []}) {
+        id
+      }
+    }
+    """,
+    'FindUserByCredentials': """
+    query FindUserByCredentials($email: String!, $password: String!) {
+      users(where: {email: {_eq: $email}, password: {_eq: $password}}) {
+        id
+      }
+    }
+    """,
+    'UserCredentials': """
+    query UserCredentials($email: String!) {
+      users(where: {email: {_eq: $email}}) {
+        id
+        password
+      }
+    }
+    """,
+    'UpdateUserPassword': """
+    mutation UpdateUserPassword($id: uuid!, $password: String!) {
+      update_users_by_pk(pk_columns: {id: $id}, _set: {password: $password}) {
+        id
+      }
+    }
+    """,
+    'UserEmail': """
+    query UserEmail($user_id: uuid!) {
+      users_by_pk(id: $user_id) {
+        email
+      }
+    }
+    """,
+    'UserEmails': """
+    query UserEmails($user_ids: [uuid!]!) {
+      users(where: {id: {_in: $user_ids}}) {
+        id
+        email
+      }
+    }
+    """,
+    'InsertTask': """
+    mutation InsertTask($task: tasks_insert_input!) {
+      insert_tasks_one(object: $task) {
+        id
+      }
+    }
+    """,
+    'TasksByIds': """
+    query TasksByIds($task_ids: [uuid!]!) {
+      tasks(where: {id: {_in: $task_ids}}) {
+        id
+        user_id
+        content
+      }
+    }
+    """,
+    'InsertResponses': """
+    mutation InsertResponses($objects: [responses_insert_input!]!) {
+      insert_responses(objects: $objects) {
+        affected_rows
+      }
+    }
+    """,
+    'UpsertTaskResult': """
+    mutation UpsertTaskResult($result: task_results_insert_input!) {
+      insert_task_results_one(object: $result, on_conflict: {constraint: task_results_pkey, update_columns: [status, results]}) {
+        task_id
+      }
+    }
+    """,
+    'TaskResult': """
+    query TaskResult($task_id: String!) {
+      task_results_by_pk(task_id: $task_id) {
+        task_id
+        user_id
+        status
+        results
+      }
+    }
+    """
+}
+
+COLLECTION_NAME = 'service_operations'
+
+class Operation:
+    def __init__(self, name, document):
+        self.name = name
+        # Collapse whitespace to keep request payloads small
+        self.document = re.sub(r'\s+', ' ', document).strip()
+        # Queries can be resent after an ambiguous failure; mutations cannot
+        self.retry_safe = self.document.startswith('query')
+        self.rest_path = re.sub(r'(?<!^)(?=[A-Z])', '-', name).lower()
+
+def validate(name, document):
+    match = re.match(r'\s*(query|mutation|subscription)\s+(\w+)\s*(\(([^)]*)\))?\s*\{', document)
+    if not match:
+        raise ValueError(f"Operation {name} must be a single named query or mutation")
+    if match.group(2) != name:
+        raise ValueError(f"Operation {name} is declared as {match.group(2)}")
+    if document.count('{') != document.count('}'):
+        raise ValueError(f"Operation {name} has unbalanced braces")
+
+    declared = set(re.findall(r'\$(\w+)\s*:', match.group(4) or ''))
+    body = document[match.end():]
+    used = set(re.findall(r'\$(\w+)', body))
+    if declared != used:
+        raise ValueError(f"Operation {name} declares {sorted(declared)} but uses {sorted(used)}")
+
+def load_operations():
+    operations = {}
+    for name, document in DOCUMENTS.items():
+        validate(name, document)
+        operations[name] = Operation(name, document)
+    return operations
+
+# Validated once, at import time, so a broken document fails service startup
+OPERATIONS = load_operations()
+
+def get_operation(name):
+    return OPERATIONS[name]
+
+def rest_metadata():
+    # Hasura metadata API payload that registers every operation in a query
+    # collection, allow-lists it and exposes it as a REST endpoint.
+    args = [
+        {
+            'type': 'create_query_collection',
+            'args': {
+                'name': COLLECTION_NAME,
+                'definition': {'queries': [{'name': op.name, 'query': op.document} for op in OPERATIONS.values()]}
+            }
+        },
+        {'type': 'add_collection_to_allowlist', 'args': {'collection': COLLECTION_NAME}}
+    ]
+    for op in OPERATIONS.values():
+        args.append({
+            'type': 'create_rest_endpoint',
+            'args': {
+                'name': op.name,
+                'url': op.rest_path,
+                'methods': ['POST'],
+                'definition': {'query': {'query_name': op.name, 'collection_name': COLLECTION_NAME}}
+            }
+        })
+    return {'type': 'bulk', 'args': args}
+
+if __name__ == '__main__':
+    json.dump(rest_metadata(), sys.stdout, indent=2)
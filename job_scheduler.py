@@ -0,0 +1,390 @@
+# job_scheduler.py
+
+import json
+import os
+import threading
+import time
+import uuid
+from datetime import datetime
+import redis
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+
+# Claims up to ARGV[3] jobs due by ARGV[1] by pushing their score out to the
+# lease expiry ARGV[2], and returns (id, payload, due time) triples. A
+# claimer that dies before completing simply lets the lease run out, at
+# which point the jobs are due again for everyone. The due time comes from
+# KEYS[3], which claiming leaves alone, so a re-claimed job reports the same
+# fire time as before.
+CLAIM_SCRIPT = """
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[3]))
+local claimed = {}
+for _, id in ipairs(ids) do
+  local payload = redis.call('HGET', KEYS[2], id)
+  if payload then
+    local run_at = redis.call('HGET', KEYS[3], id) or redis.call('ZSCORE', KEYS[1], id)
+    redis.call('ZADD', KEYS[1], ARGV[2], id)
+    claimed[#claimed + 1] = id
+    claimed[#claimed + 1] = payload
+    claimed[#claimed + 1] = run_at
+  else
+    redis.call('ZREM', KEYS[1], id)
+    redis.call('HDEL', KEYS[3], id)
+  end
+end
+return claimed
+"""
+
+# Completes claimed jobs, but only those still holding this claim's lease; a
+# job rescheduled or cancelled while it was being dispatched is left alone.
+# ARGV: lease, then (id, next_run or '') pairs.
+COMPLETE_SCRIPT = """
+local completed = 0
+for i = 2, #ARGV, 2 do
+  local score = redis.call('ZSCORE', KEYS[1], ARGV[i])
+  if score and tonumber(score) == tonumber(ARGV[1]) then
+    if ARGV[i + 1] == '' then
+      redis.call('ZREM', KEYS[1], ARGV[i])
+      redis.call('HDEL', KEYS[2], ARGV[i])
+      redis.call('HDEL', KEYS[3], ARGV[i])
+    else
+      redis.call('ZADD', KEYS[1], ARGV[i + 1], ARGV[i])
+      redis.call('HSET', KEYS[3], ARGV[i], ARGV[i + 1])
+    end
+    completed = completed + 1
+  end
+end
+return completed
+"""
+
+# Extends the lease of claimed jobs from ARGV[1] to ARGV[2] while their
+# handler is still running; ARGV[3..] are job ids. Jobs no longer holding
+# the old lease (rescheduled or cancelled meanwhile) are left alone.
+RENEW_SCRIPT = """
+local renewed = 0
+for i = 3, #ARGV do
+  local score = redis.call('ZSCORE', KEYS[1], ARGV[i])
+  if score and tonumber(score) == tonumber(ARGV[1]) then
+    redis.call('ZADD', KEYS[1], ARGV[2], ARGV[i])
+    renewed = renewed + 1
+  end
+end
+return renewed
+"""
+
+# Applies a list of (op, id, run_at, payload, owner) writes in one atomic
+# step and returns 1 or 0 per write. 'add' fails if the job exists;
+# 'reschedule' and 'remove' fail if it does not, or if an owner is given and
+# the stored payload belongs to another user. A reschedule with an empty
+# payload keeps the stored one.
+APPLY_SCRIPT = """
+local function owned(id, owner)
+  if owner == '' then
+    return redis.call('HEXISTS', KEYS[2], id) == 1
+  end
+  local stored = redis.call('HGET', KEYS[2], id)
+  return stored ~= false and cjson.decode(stored)['user_id'] == owner
+end
+
+local results = {}
+for i = 1, #ARGV, 5 do
+  local op, id, run_at, payload, owner = ARGV[i], ARGV[i + 1], ARGV[i + 2], ARGV[i + 3], ARGV[i + 4]
+  local applied = 0
+  if op == 'add' then
+    if redis.call('HSETNX', KEYS[2], id, payload) == 1 then
+      redis.call('ZADD', KEYS[1], run_at, id)
+      redis.call('HSET', KEYS[3], id, run_at)
+      applied = 1
+    end
+  elseif op == 'reschedule' then
+    if owned(id, owner) then
+      if payload ~= '' then
+        redis.call('HSET', KEYS[2], id, payload)
+      end
+      redis.call('ZADD', KEYS[1], run_at, id)
+      redis.call('HSET', KEYS[3], id, run_at)
+      applied = 1
+    end
+  elseif op == 'remove' then
+    if owned(id, owner) then
+      redis.call('ZREM', KEYS[1], id)
+      redis.call('HDEL', KEYS[3], id)
+      applied = redis.call('HDEL', KEYS[2], id)
+    end
+  end
+  results[#results + 1] = applied
+end
+return results
+"""
+
+INTERVAL_UNITS = ('weeks', 'days', 'hours', 'minutes', 'seconds')
+
+# Per-item status reported by apply_requests, by store op and outcome
+OPERATION_STATUS = {
+    'add': ('scheduled', 'conflict'),
+    'reschedule': ('rescheduled', 'not_found'),
+    'remove': ('cancelled', 'not_found')
+}
+
+def connect_redis():
+    host = os.getenv('SCHEDULER_REDIS_HOST', os.getenv('REDIS_HOST', 'localhost'))
+    return redis.Redis(host=host, port=int(os.getenv('REDIS_PORT', 6379)), db=0)
+
+def parse_time(value):
+    """Epoch seconds for an ISO-8601 timestamp. Naive times are local, as
+    they were with APScheduler."""
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, datetime):
+        return value.timestamp()
+    return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+def build_trigger(spec):
+    """APScheduler trigger for a recurring job spec, or None for a one-shot.
+
+    Specs are {'type': 'cron', 'expression': '0 9 * * *'} or
+    {'type': 'interval', 'hours': 24, 'start_date': ..., 'end_date': ...},
+    each with an optional 'timezone'.
+    """
+    if not spec or spec.get('type', 'date') == 'date':
+        return None
+    if spec['type'] == 'cron':
+        return CronTrigger.from_crontab(spec['expression'], timezone=spec.get('timezone'))
+    if spec['type'] == 'interval':
+        units = {unit: spec[unit] for unit in INTERVAL_UNITS if spec.get(unit)}
+        if not units:
+            raise ValueError('Interval trigger needs at least one of ' + ', '.join(INTERVAL_UNITS))
+        return IntervalTrigger(
+            start_date=spec.get('start_date'),
+            end_date=spec.get('end_date'),
+            timezone=spec.get('timezone'),
+            **units
+        )
+    raise ValueError(f"Unknown trigger type: {spec['type']}")
+
+def next_fire_time(spec, now=None):
+    """Epoch seconds of the trigger's next fire time after `now`, or None
+    once it is exhausted."""
+    trigger = build_trigger(spec)
+    if trigger is None:
+        return None
+    fire_time = trigger.get_next_fire_time(None, datetime.fromtimestamp(now or time.time(), trigger.timezone))
+    return fire_time.timestamp() if fire_time else None
+
+def parse_task_id(value):
+    # Task ids are Hasura uuids; anything else could never be dispatched
+    if not isinstance(value, str):
+        raise ValueError('task_id must be a UUID string')
+    try:
+        return str(uuid.UUID(value))
+    except ValueError:
+        raise ValueError(f"task_id is not a UUID: {value}")
+
+def parse_operation(item, user_id):
+    """Turn one schedule/reschedule/cancel request item into a store write.
+
+    Returns (op, job_id, run_at, payload); raises ValueError (or KeyError for
+    a missing field) when the item is invalid.
+    """
+    op = item.get('op')
+    task_id = parse_task_id(item['task_id'])
+    if op == 'cancel':
+        return 'remove', task_id, 0, None
+
+    if op not in ('schedule', 'reschedule'):
+        raise ValueError(f"Unknown op: {op}")
+    time_field = 'schedule_time' if op == 'schedule' else 'new_schedule_time'
+    spec = item.get('trigger')
+    if spec and spec.get('type', 'date') != 'date':
+        run_at = next_fire_time(spec)
+        if run_at is None:
+            raise ValueError('Trigger never fires')
+    else:
+        run_at = parse_time((spec or {}).get('run_date') or item[time_field])
+        spec = None
+
+    if op == 'reschedule' and 'trigger' not in item:
+        # Only the next run moves; the job keeps its trigger
+        return 'reschedule', task_id, run_at, None
+    payload = {'task_id': task_id, 'user_id': user_id, 'trigger': spec}
+    return ('add' if op == 'schedule' else 'reschedule'), task_id, run_at, payload
+
+class RedisScheduler:
+    """Job store and dispatcher backed by a Redis sorted set.
+
+    `<namespace>:due` scores job ids by their next run time (or, while
+    claimed, their lease expiry), `<namespace>:due_at` keeps each job's
+    actual fire time and `<namespace>:jobs` holds its JSON payload, so the
+    store is shared
+    by every replica and worker. Each replica polls for due jobs; claiming
+    is an atomic script that leases the jobs to one claimer, so a job is
+    handed to exactly one `handler(jobs)` call, which may return the ids of
+    jobs it could not resolve; those are deleted rather than rescheduled. The lease is renewed every
+    third of its length while the handler runs, however long the batch
+    takes, and the jobs are completed after the handler returns; if it
+    raises or the process dies, the lease expires and the jobs are claimed
+    again.
+    """
+
+    def __init__(self, handler, redis_client=None, namespace='scheduler', poll_interval=None, batch_size=None, lease=None, window=None):
+        self.handler = handler
+        self.redis = redis_client or connect_redis()
+        self.due_key = f"{namespace}:due"
+        self.jobs_key = f"{namespace}:jobs"
+        self.due_at_key = f"{namespace}:due_at"
+        self.poll_interval = poll_interval or float(os.getenv('SCHEDULER_POLL_INTERVAL', 1))
+        self.batch_size = batch_size or int(os.getenv('SCHEDULER_BATCH_SIZE', 500))
+        self.lease = lease or float(os.getenv('SCHEDULER_LEASE', 60))
+        # Jobs due within this many seconds are dispatched together with the
+        # ones already due, rather than trickling out one poll at a time
+        self.window = float(os.getenv('SCHEDULER_WINDOW', 1)) if window is None else window
+        self._claim = self.redis.register_script(CLAIM_SCRIPT)
+        self._complete = self.redis.register_script(COMPLETE_SCRIPT)
+        self._renew = self.redis.register_script(RENEW_SCRIPT)
+        self._apply = self.redis.register_script(APPLY_SCRIPT)
+        self._stopped = threading.Event()
+        self._thread = None
+        self.counts = {'dispatched': 0, 'batches': 0, 'errors': 0, 'renewals': 0, 'dropped': 0}
+
+    def apply(self, operations, owner=None):
+        """Apply (op, job_id, run_at, payload) writes atomically; returns
+        whether each one took effect. With an `owner`, reschedules and
+        removals only touch jobs whose payload has that user_id."""
+        if not operations:
+            return []
+        args = []
+        for op, job_id, run_at, payload in operations:
+            args.extend([op, job_id, parse_time(run_at), '' if payload is None else json.dumps(payload), owner or ''])
+        return [bool(applied) for applied in self._apply(keys=[self.due_key, self.jobs_key, self.due_at_key], args=args)]
+
+    def apply_requests(self, items, user_id):
+        """Validate and apply a batch of schedule/reschedule/cancel request
+        items in one store transaction; returns a status per item. Jobs of
+        other users are reported as not_found."""
+        results = [None] * len(items)
+        operations = []
+        indexes = []
+        for i, item in enumerate(items):
+            try:
+                operations.append(parse_operation(item, user_id))
+                indexes.append(i)
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                task_id = item.get('task_id') if isinstance(item, dict) else None
+                results[i] = {'task_id': task_id, 'status': 'invalid', 'error': str(e)}
+        for i, operation, applied in zip(indexes, operations, self.apply(operations, owner=user_id)):
+            succeeded, failed = OPERATION_STATUS[operation[0]]
+            results[i] = {'task_id': operation[1], 'status': succeeded if applied else failed}
+        return results
+
+    def add(self, job_id, run_at, payload):
+        """Store a job; returns False if `job_id` already exists."""
+        return self.apply([('add', job_id, run_at, payload)])[0]
+
+    def reschedule(self, job_id, run_at, owner=None):
+        """Move a job's next run to `run_at`; returns False if there is no
+        such job (owned by `owner`, when given)."""
+        return self.apply([('reschedule', job_id, run_at, None)], owner)[0]
+
+    def remove(self, job_id, owner=None):
+        """Delete a job; returns False if there is no such job (owned by
+        `owner`, when given)."""
+        return self.apply([('remove', job_id, 0, None)], owner)[0]
+
+    def get(self, job_id):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hget(self.jobs_key, job_id)
+        pipe.hget(self.due_at_key, job_id)
+        pipe.zscore(self.due_key, job_id)
+        payload, due_at, score = pipe.execute()
+        if payload is None:
+            return None
+        return dict(json.loads(payload), id=job_id, next_run_time=float(due_at) if due_at is not None else score)
+
+    def next_run(self, job, now):
+        # One-shot jobs are deleted once dispatched; recurring ones move on
+        # to their next fire time until the trigger is exhausted
+        try:
+            return next_fire_time(job.get('trigger'), now)
+        except (ValueError, KeyError) as e:
+            print(f"Dropping job {job['id']} with an invalid trigger: {str(e)}")
+            return None
+
+    def run_pending(self):
+        """Claim and dispatch one batch of due jobs; returns how many."""
+        now = time.time()
+        lease_until = now + self.lease
+        horizon = now + self.window
+        claimed = self._claim(keys=[self.due_key, self.jobs_key, self.due_at_key], args=[horizon, lease_until, self.batch_size])
+        jobs = [
+            dict(json.loads(payload), id=job_id.decode('utf-8'), run_at=float(run_at))
+            for job_id, payload, run_at in zip(claimed[::3], claimed[1::3], claimed[2::3])
+        ]
+        if not jobs:
+            return 0
+
+        lease_until, dropped = self._run_handler(jobs, lease_until)
+
+        args = [lease_until]
+        for job in jobs:
+            # Strictly after the claim horizon, so a recurring job claimed
+            # slightly early is not handed its current fire time again
+            next_run = None if job['id'] in dropped else self.next_run(job, horizon + 0.001)
+            args.extend([job['id'], '' if next_run is None else next_run])
+        self._complete(keys=[self.due_key, self.jobs_key, self.due_at_key], args=args)
+        self.counts['dispatched'] += len(jobs) - len(dropped)
+        self.counts['dropped'] += len(dropped)
+        self.counts['batches'] += 1
+        return len(jobs)
+
+    def _run_handler(self, jobs, lease_until):
+        # Runs the handler while a heartbeat thread keeps the jobs leased;
+        # returns the lease they hold once it is done and the ids it dropped
+        lease = {'until': lease_until}
+        done = threading.Event()
+        ids = [job['id'] for job in jobs]
+
+        def heartbeat():
+            while not done.wait(self.lease / 3):
+                renewed_until = time.time() + self.lease
+                try:
+                    self._renew(keys=[self.due_key], args=[lease['until'], renewed_until] + ids)
+                    lease['until'] = renewed_until
+                    self.counts['renewals'] += 1
+                except redis.RedisError as e:
+                    print(f"Scheduler lease renewal failed: {str(e)}")
+
+        thread = threading.Thread(target=heartbeat, name='scheduler-lease', daemon=True)
+        thread.start()
+        try:
+            dropped = set(self.handler(jobs) or ())
+        finally:
+            done.set()
+            thread.join()
+        return lease['until'], dropped
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                dispatched = self.run_pending()
+            except Exception as e:
+                self.counts['errors'] += 1
+                print(f"Scheduler dispatch failed: {str(e)}")
+                dispatched = 0
+            # Keep draining while there is a backlog; otherwise poll
+            if dispatched < self.batch_size:
+                self._stopped.wait(self.poll_interval)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='scheduler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def stats(self):
+        try:
+            pending = self.redis.zcard(self.due_key)
+        except redis.RedisError:
+            pending = None
+        return dict(self.counts, pending=pending)
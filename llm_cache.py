@@ -0,0 +1,97 @@
+# llm_cache.py
+
+import asyncio
+import hashlib
+import json
+import os
+import re
+from ttl_cache import TTLCache, MISSING
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+local_cache = TTLCache(
+    maxsize=int(os.getenv('LLM_CACHE_SIZE', 1024)),
+    ttl=int(os.getenv('LLM_CACHE_TTL', 3600))
+)
+redis_stats = {'hits': 0, 'misses': 0, 'errors': 0}
+
+def connect_redis():
+    host = os.getenv('LLM_CACHE_REDIS_HOST', os.getenv('REDIS_HOST'))
+    if redis is None or not host:
+        return None
+    return redis.Redis(host=host, port=int(os.getenv('REDIS_PORT', 6379)), db=0, socket_timeout=0.25)
+
+redis_client = connect_redis()
+
+def use_redis(client):
+    # Let services that already hold a Redis connection share it with the cache
+    global redis_client
+    redis_client = client
+
+def normalize_prompt(prompt):
+    return re.sub(r'\s+', ' ', prompt).strip().lower()
+
+def cache_key(provider, model, prompt):
+    digest = hashlib.sha256(f"{provider}\0{model}\0{normalize_prompt(prompt)}".encode('utf-8')).hexdigest()
+    return f"llm_cache:{digest}"
+
+def lookup(provider, model, prompt):
+    key = cache_key(provider, model, prompt)
+    value = local_cache.get(key, MISSING)
+    if value is not MISSING:
+        return value
+
+    if redis_client is not None:
+        try:
+            raw = redis_client.get(key)
+        except redis.RedisError as e:
+            redis_stats['errors'] += 1
+            print(f"LLM cache Redis lookup failed: {str(e)}")
+            return None
+        if raw is not None:
+            redis_stats['hits'] += 1
+            value = json.loads(raw)
+            local_cache.set(key, value)
+            return value
+        redis_stats['misses'] += 1
+    return None
+
+def store(provider, model, prompt, value):
+    key = cache_key(provider, model, prompt)
+    local_cache.set(key, value)
+    if redis_client is not None:
+        try:
+            redis_client.set(key, json.dumps(value), ex=local_cache.ttl)
+        except redis.RedisError as e:
+            redis_stats['errors'] += 1
+            print(f"LLM cache Redis store failed: {str(e)}")
+
+# Async callers share the event loop with every other request, so the
+# blocking Redis round-trip runs on the loop's default executor; local hits
+# are still answered inline.
+async def lookup_async(provider, model, prompt):
+    value = local_cache.get(cache_key(provider, model, prompt), MISSING)
+    if value is not MISSING:
+        return value
+    if redis_client is None:
+        return None
+    return await asyncio.get_running_loop().run_in_executor(None, lookup, provider, model, prompt)
+
+async def store_async(provider, model, prompt, value):
+    if redis_client is None:
+        store(provider, model, prompt, value)
+        return
+    await asyncio.get_running_loop().run_in_executor(None, store, provider, model, prompt, value)
+
+def cached(provider, model, prompt, compute):
+    value = lookup(provider, model, prompt)
+    if value is None:
+        value = compute()
+        store(provider, model, prompt, value)
+    return value
+
+def stats():
+    return {'local': local_cache.stats(), 'redis': dict(redis_stats, enabled=redis_client is not None)}
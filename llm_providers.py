@@ -0,0 +1,120 @@
+# llm_providers.py
+
+import os
+
+# Provider SDKs are imported lazily so each advisor container only needs the
+# SDK for the provider it actually talks to.
+_clients = {}
+
+API_KEYS = {
+    'openai': os.getenv('OPENAI_API_KEY'),
+    'anthropic': os.getenv('ANTHROPIC_API_KEY'),
+    'google': os.getenv('GOOGLE_AI_API_KEY')
+}
+
+def configure(**keys):
+    # Override API keys (e.g. from Flask config) before the first call
+    API_KEYS.update({provider: key for provider, key in keys.items() if key})
+    _clients.clear()
+
+# Most completion tokens each provider's models will produce in one call;
+# larger max_tokens values are rejected
+MAX_OUTPUT_TOKENS = {
+    'openai': int(os.getenv('OPENAI_MAX_OUTPUT_TOKENS', 4096)),
+    'anthropic': int(os.getenv('ANTHROPIC_MAX_OUTPUT_TOKENS', 4096)),
+    'google': int(os.getenv('GOOGLE_MAX_OUTPUT_TOKENS', 2048))
+}
+
+def _openai():
+    if 'openai' not in _clients:
+        import openai
+        openai.api_key = API_KEYS['openai']
+        _clients['openai'] = openai
+    return _clients['openai']
+
+def _anthropic():
+    if 'anthropic' not in _clients:
+        import anthropic
+        _clients['anthropic'] = anthropic.AsyncAnthropic(api_key=API_KEYS['anthropic'])
+    return _clients['anthropic']
+
+def _google():
+    if 'google' not in _clients:
+        import google.generativeai as genai
+        genai.configure(api_key=API_KEYS['google'])
+        _clients['google'] = genai
+    return _clients['google']
+
+async def openai_complete(model, system, prompt, max_tokens=None):
+    messages = [{"role": "user", "content": prompt}]
+    if system:
+        messages.insert(0, {"role": "system", "content": system})
+    kwargs = {'max_tokens': max_tokens} if max_tokens else {}
+    response = await _openai().ChatCompletion.acreate(model=model, messages=messages, **kwargs)
+    return response.choices[0].message['content']
+
+async def anthropic_complete(model, system, prompt, max_tokens=None):
+    kwargs = {'system': system} if system else {}
+    response = await _anthropic().messages.create(
+        model=model,
+        max_tokens=max_tokens or MAX_OUTPUT_TOKENS['anthropic'],
+        messages=[{"role": "user", "content": prompt}],
+        **kwargs
+    )
+    return ''.join(block.text for block in response.content if block.type == 'text')
+
+def _google_prompt(system, prompt):
+    return f"{system}\n\n{prompt}" if system else prompt
+
+async def google_complete(model, system, prompt, max_tokens=None):
+    response = await _google().GenerativeModel(model).generate_content_async(_google_prompt(system, prompt))
+    return response.text
+
+async def openai_stream(model, system, prompt, max_tokens=None):
+    messages = [{"role": "user", "content": prompt}]
+    if system:
+        messages.insert(0, {"role": "system", "content": system})
+    kwargs = {'max_tokens': max_tokens} if max_tokens else {}
+    response = await _openai().ChatCompletion.acreate(model=model, messages=messages, stream=True, **kwargs)
+    async for chunk in response:
+        delta = chunk.choices[0].delta.get('content')
+        if delta:
+            yield delta
+
+async def anthropic_stream(model, system, prompt, max_tokens=None):
+    kwargs = {'system': system} if system else {}
+    response = await _anthropic().messages.create(
+        model=model,
+        max_tokens=max_tokens or MAX_OUTPUT_TOKENS['anthropic'],
+        messages=[{"role": "user", "content": prompt}],
+        stream=True,
+        **kwargs
+    )
+    async for event in response:
+        if event.type == 'content_block_delta' and event.delta.type == 'text_delta':
+            yield event.delta.text
+
+async def google_stream(model, system, prompt, max_tokens=None):
+    response = await _google().GenerativeModel(model).generate_content_async(_google_prompt(system, prompt), stream=True)
+    async for chunk in response:
+        if chunk.text:
+            yield chunk.text
+
+PROVIDERS = {
+    'openai': openai_complete,
+    'anthropic': anthropic_complete,
+    'google': google_complete
+}
+
+STREAMING_PROVIDERS = {
+    'openai': openai_stream,
+    'anthropic': anthropic_stream,
+    'google': google_stream
+}
+
+async def complete(provider, model, system, prompt, max_tokens=None):
+    return await PROVIDERS[provider](model, system, prompt, max_tokens)
+
+def stream(provider, model, system, prompt, max_tokens=None):
+    # Async iterator over text deltas as the provider produces them
+    return STREAMING_PROVIDERS[provider](model, system, prompt, max_tokens)
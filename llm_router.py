@@ -0,0 +1,352 @@
+# llm_router.py
+
+import asyncio
+import concurrent.futures
+import json
+import os
+import re
+import threading
+import time
+from collections import deque
+import llm_cache
+import llm_providers
+from token_budget import TokenBudget, estimate_tokens
+from advisors import ADVISORS, COMBINED_ADVISOR, build_prompt, build_combined_prompt, cache_prompt, postprocess, primary_route
+
+HEDGE_DEFAULT_DELAY = float(os.getenv('LLM_HEDGE_DEFAULT_DELAY', 8))
+HEDGE_MIN_SAMPLES = int(os.getenv('LLM_HEDGE_MIN_SAMPLES', 20))
+STATS_WINDOW = int(os.getenv('LLM_STATS_WINDOW', 200))
+RATE_LIMIT_COOLDOWN = float(os.getenv('LLM_RATE_LIMIT_COOLDOWN', 30))
+UNHEALTHY_ERROR_RATE = float(os.getenv('LLM_UNHEALTHY_ERROR_RATE', 0.5))
+STREAM_FLUSH_MS = int(os.getenv('STREAM_FLUSH_MS', 100))
+
+class ProviderStats:
+    def __init__(self, window=STATS_WINDOW):
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+        self.cooldown_until = 0.0
+
+    def record(self, elapsed, error=None):
+        self.outcomes.append(error is None)
+        if error is None:
+            self.latencies.append(elapsed)
+        elif is_rate_limited(error):
+            self.cooldown_until = time.monotonic() + RATE_LIMIT_COOLDOWN
+
+    def percentile(self, p):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+    def error_rate(self):
+        if not self.outcomes:
+            return 0.0
+        return 1 - sum(self.outcomes) / len(self.outcomes)
+
+    def healthy(self):
+        return time.monotonic() >= self.cooldown_until and self.error_rate() < UNHEALTHY_ERROR_RATE
+
+    def hedge_delay(self):
+        if len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        return self.percentile(0.95)
+
+def is_rate_limited(error):
+    status = getattr(error, 'status_code', None) or getattr(error, 'http_status', None) or getattr(error, 'code', None)
+    return status == 429 or 'rate limit' in str(error).lower()
+
+class Router:
+    """Calls advisors by capability rather than by vendor.
+
+    Each capability has an ordered list of (provider, model) routes. A
+    request goes to the first healthy route; if it is still running after
+    that route's p95 latency, one hedged duplicate goes to the next route and
+    whichever answers first wins. Errors (including 429s, which also put the
+    provider in a short cooldown) fail over to the next route.
+    """
+
+    def __init__(self, routes, budget=None):
+        self.routes = routes
+        self.stats = {}
+        self.budget = budget or TokenBudget()
+
+    def _stats(self, provider, model):
+        return self.stats.setdefault((provider, model), ProviderStats())
+
+    def candidates(self, capability, tokens=0):
+        # Keep the configured preference order, but push unhealthy routes and
+        # routes whose provider is out of token budget to the back
+        routes = self.routes[capability]
+        return sorted(routes, key=lambda route: (
+            not self._stats(*route).healthy(),
+            self.budget.wait_time(route[0], tokens) > 0
+        ))
+
+    def output_limit(self, capability):
+        # Requests may land on any route, so they must fit the smallest
+        return min(llm_providers.MAX_OUTPUT_TOKENS[provider] for provider, _ in self.routes[capability])
+
+    def _estimate(self, system, prompt, max_tokens):
+        return estimate_tokens(f"{system or ''}{prompt}") + (max_tokens or 300)
+
+    async def _call(self, route, system, prompt, max_tokens, admitted=None):
+        await self.budget.admit(route[0], f"{system or ''}{prompt}", max_tokens)
+        if admitted is not None:
+            admitted.set()
+        start = time.monotonic()
+        try:
+            result = await llm_providers.complete(route[0], route[1], system, prompt, max_tokens)
+        except Exception as e:
+            self._stats(*route).record(time.monotonic() - start, e)
+            raise
+        self._stats(*route).record(time.monotonic() - start)
+        return result
+
+    async def complete(self, capability, system, prompt, max_tokens=None):
+        candidates = self.candidates(capability, self._estimate(system, prompt, max_tokens))
+        pending = set()
+        routes = {}
+        # Per task: set once its budget admits it, and when that was seen.
+        # Time spent waiting for budget is not provider latency, so the hedge
+        # clock only starts at admission.
+        admissions = {}
+        admitted_at = {}
+        next_index = 0
+        last_error = None
+
+        def launch():
+            nonlocal next_index
+            route = candidates[next_index]
+            next_index += 1
+            admitted = asyncio.Event()
+            task = asyncio.create_task(self._call(route, system, prompt, max_tokens, admitted))
+            routes[task] = route
+            admissions[task] = admitted
+            pending.add(task)
+
+        launch()
+        try:
+            while pending:
+                hedge_after = None
+                admission = None
+                if len(pending) == 1 and next_index < len(candidates):
+                    task = next(iter(pending))
+                    if admissions[task].is_set():
+                        started = admitted_at.setdefault(task, time.monotonic())
+                        hedge_after = max(0, self._stats(*routes[task]).hedge_delay() - (time.monotonic() - started))
+                    else:
+                        admission = asyncio.create_task(admissions[task].wait())
+                done, _ = await asyncio.wait(
+                    pending if admission is None else pending | {admission},
+                    timeout=hedge_after,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                if admission is not None:
+                    admission.cancel()
+                    if admission in done:
+                        done.discard(admission)
+                        if not done:
+                            continue
+                if not done:
+                    # Slower than its usual tail: hedge on the next route
+                    launch()
+                    continue
+                for task in done:
+                    pending.discard(task)
+                    if task.exception() is None:
+                        return task.result()
+                    last_error = task.exception()
+                    print(f"LLM route {routes[task]} failed for {capability}: {str(last_error)}")
+                if not pending and next_index < len(candidates):
+                    launch()
+            raise last_error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def stream(self, capability, system, prompt, max_tokens=None):
+        # Streams cannot be hedged without duplicating output, so they only
+        # fail over, and only until the first delta has been sent.
+        last_error = None
+        for route in self.candidates(capability, self._estimate(system, prompt, max_tokens)):
+            await self.budget.admit(route[0], f"{system or ''}{prompt}", max_tokens)
+            start = time.monotonic()
+            started = False
+            try:
+                async for delta in llm_providers.stream(route[0], route[1], system, prompt, max_tokens):
+                    started = True
+                    yield delta
+            except Exception as e:
+                self._stats(*route).record(time.monotonic() - start, e)
+                if started:
+                    raise
+                last_error = e
+                print(f"LLM route {route} failed for {capability}: {str(e)}")
+                continue
+            self._stats(*route).record(time.monotonic() - start)
+            return
+        raise last_error
+
+    def summary(self):
+        return {
+            f"{provider}/{model}": {
+                'p50': stats.percentile(0.5),
+                'p95': stats.percentile(0.95),
+                'error_rate': stats.error_rate(),
+                'healthy': stats.healthy()
+            }
+            for (provider, model), stats in self.stats.items()
+        }
+
+COMBINED = 'combined'
+
+router = Router(dict({service: advisor['routes'] for service, advisor in ADVISORS.items()}, **{COMBINED: COMBINED_ADVISOR['routes']}))
+
+def lookup_advice(service, content):
+    provider, model = primary_route(service)
+    return llm_cache.lookup(provider, model, cache_prompt(service, content))
+
+async def lookup_advice_async(service, content):
+    provider, model = primary_route(service)
+    return await llm_cache.lookup_async(provider, model, cache_prompt(service, content))
+
+async def store_advice(service, content, result):
+    provider, model = primary_route(service)
+    await llm_cache.store_async(provider, model, cache_prompt(service, content), result)
+
+async def generate_text(service, content, emit=None):
+    advisor = ADVISORS[service]
+    args = (service, advisor['system'], build_prompt(service, content), advisor.get('max_tokens'))
+    if emit is None:
+        return await router.complete(*args)
+
+    # Forward deltas as they arrive, coalesced to a line or STREAM_FLUSH_MS so
+    # a fast provider does not turn into one bus message per token.
+    text, pending = [], []
+    last_flush = time.monotonic()
+    async for delta in router.stream(*args):
+        text.append(delta)
+        pending.append(delta)
+        if '\n' in delta or (time.monotonic() - last_flush) * 1000 >= STREAM_FLUSH_MS:
+            await emit({'type': 'chunk', 'delta': ''.join(pending)})
+            pending = []
+            last_flush = time.monotonic()
+    if pending:
+        await emit({'type': 'chunk', 'delta': ''.join(pending)})
+    return ''.join(text)
+
+async def advise(service, content, emit=None):
+    # Answers are cached under the advisor's preferred route, whichever
+    # provider actually produced them.
+    result = await lookup_advice_async(service, content)
+    if result is None:
+        text = await generate_text(service, content, emit)
+        result = postprocess(service, text)
+        await store_advice(service, content, result)
+    return result
+
+def batch_prompt(service, contents):
+    items = '\n\n'.join(f"Item {i + 1}: {build_prompt(service, content)}" for i, content in enumerate(contents))
+    return (
+        f"Answer each of the following {len(contents)} items independently. "
+        f"Respond with only a JSON array of {len(contents)} strings, in the same order, "
+        f"where element N is the complete answer to item N.\n\n{items}"
+    )
+
+def parse_json(text):
+    return json.loads(re.sub(r'^```(?:json)?\s*|\s*```$', '', text.strip()))
+
+def parse_batch(text, count):
+    answers = parse_json(text)
+    if not isinstance(answers, list) or len(answers) != count:
+        raise ValueError(f"Expected a JSON array of {count} answers")
+    return [answer if isinstance(answer, str) else json.dumps(answer) for answer in answers]
+
+async def _advise_misses(service, contents):
+    # One multi-item call for uncached contents. If it fails or its answer
+    # cannot be split back into items, each item falls back to its own call.
+    if len(contents) == 1:
+        return [await advise(service, contents[0])]
+    advisor = ADVISORS[service]
+    max_tokens = min((advisor.get('max_tokens') or router.output_limit(service)) * len(contents), router.output_limit(service))
+    try:
+        text = await router.complete(service, advisor['system'], batch_prompt(service, contents), max_tokens)
+        answers = parse_batch(text, len(contents))
+    except Exception as e:
+        print(f"Batched {service} call failed, retrying per item: {str(e)}")
+        return list(await asyncio.gather(*(advise(service, content) for content in contents)))
+
+    results = [postprocess(service, answer) for answer in answers]
+    await asyncio.gather(*(store_advice(service, content, result) for content, result in zip(contents, results)))
+    return results
+
+async def advise_batch(service, contents):
+    # Cached items are answered directly; the rest share multi-item prompts,
+    # as many items per prompt as fit in every route's output limit.
+    results = list(await asyncio.gather(*(lookup_advice_async(service, content) for content in contents)))
+    misses = [i for i, result in enumerate(results) if result is None]
+    # Uncapped advisors may need the whole limit, so they get a prompt each
+    per_prompt = max(1, router.output_limit(service) // (ADVISORS[service].get('max_tokens') or router.output_limit(service)))
+    groups = [misses[start:start + per_prompt] for start in range(0, len(misses), per_prompt)]
+    answers = await asyncio.gather(*(_advise_misses(service, [contents[i] for i in group]) for group in groups))
+    for group, group_results in zip(groups, answers):
+        for i, result in zip(group, group_results):
+            results[i] = result
+    return results
+
+async def advise_combined(content):
+    # Every advisor's section from one provider call. Sections are cached
+    # under the same keys as the individual advisors, so the two modes share
+    # hits. Raises ValueError when the reply is missing a section.
+    cached = await asyncio.gather(*(lookup_advice_async(service, content) for service in ADVISORS))
+    results = dict(zip(ADVISORS, cached))
+    if all(result is not None for result in results.values()):
+        return results
+
+    text = await router.complete(
+        COMBINED,
+        COMBINED_ADVISOR['system'],
+        build_combined_prompt(content),
+        COMBINED_ADVISOR['max_tokens']
+    )
+    sections = parse_json(text)
+    if not isinstance(sections, dict) or not set(ADVISORS) <= set(sections):
+        raise ValueError('Combined answer is missing advisor sections')
+
+    for service in ADVISORS:
+        section = sections[service]
+        if isinstance(section, list):
+            section = '\n'.join(str(step) for step in section)
+        results[service] = postprocess(service, str(section))
+    await asyncio.gather(*(store_advice(service, content, results[service]) for service in ADVISORS))
+    return results
+
+# Synchronous callers (main-app's worker threads) share one background event
+# loop, so the async provider clients keep their connection pools.
+_loop = None
+_loop_lock = threading.Lock()
+
+def _background_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, daemon=True).start()
+    return _loop
+
+def _wait(coroutine, timeout):
+    # A caller that gives up cancels the coroutine too, so an abandoned call
+    # stops spending provider time and budget in the background
+    future = asyncio.run_coroutine_threadsafe(coroutine, _background_loop())
+    try:
+        return future.result(timeout)
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        raise
+
+def advise_sync(service, content, timeout=None):
+    return _wait(advise(service, content), timeout)
+
+def advise_combined_sync(content, timeout=None):
+    return _wait(advise_combined(content), timeout)
@@ -3,18 +3,24 @@
 from flask import Flask, request, jsonify
 import os
 import jwt
-from functools import wraps
-import requests
+import json
 import uuid
+import queue
+import time
+import concurrent.futures
+import threading
 from datetime import datetime, timedelta
-import openai
-import anthropic
-import google.generativeai as genai
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
-from apscheduler.executors.pool import ThreadPoolExecutor
-import smtplib
 from email.message import EmailMessage
+import llm_cache
+import llm_providers
+import llm_router
+import auth
+import user_email_cache
+from hasura_client import HasuraClient
+from smtp_pool import SMTPPool
+from delivery_queue import DeliveryQueue
+from job_scheduler import RedisScheduler
+from auth import token_required
 
 app = Flask(__name__)
 
@@ -29,51 +35,42 @@ app.config['SMTP_SERVER'] = os.environ.get('SMTP_SERVER', 'smtp.gmail.com')
 app.config['SMTP_PORT'] = int(os.environ.get('SMTP_PORT', 587))
 app.config['SMTP_USERNAME'] = os.environ.get('SMTP_USERNAME', 'your-email@gmail.com')
 app.config['SMTP_PASSWORD'] = os.environ.get('SMTP_PASSWORD', 'your-email-password')
+app.config['SMTP_MAX_MESSAGES_PER_CONNECTION'] = int(os.environ.get('SMTP_MAX_MESSAGES_PER_CONNECTION', 100))
+app.config['NOTIFY_WORKERS'] = int(os.environ.get('NOTIFY_WORKERS', 2))
+app.config['NOTIFY_QUEUE_SIZE'] = int(os.environ.get('NOTIFY_QUEUE_SIZE', 1000))
+app.config['NOTIFY_BATCH_SIZE'] = int(os.environ.get('NOTIFY_BATCH_SIZE', 20))
+app.config['ADVISOR_WORKERS'] = int(os.environ.get('ADVISOR_WORKERS', 20))
+app.config['ADVISOR_TIMEOUT'] = float(os.environ.get('ADVISOR_TIMEOUT', 15))
+app.config['TASK_BUDGET'] = float(os.environ.get('TASK_BUDGET', 20))
+app.config['COMBINED_MODE_MAX_CHARS'] = int(os.environ.get('COMBINED_MODE_MAX_CHARS', 200))
+app.config['MAX_SCHEDULE_BATCH'] = int(os.environ.get('MAX_SCHEDULE_BATCH', 1000))
+app.config['REPLAY_WORKERS'] = int(os.environ.get('REPLAY_WORKERS', 4))
+app.config['REPLAY_QUEUE_SIZE'] = int(os.environ.get('REPLAY_QUEUE_SIZE', 100))
+
+auth.configure(app.config['JWT_SECRET'])
+hasura = HasuraClient(app.config['HASURA_ENDPOINT'], app.config['HASURA_ADMIN_SECRET'])
+smtp = SMTPPool(
+    app.config['SMTP_SERVER'],
+    app.config['SMTP_PORT'],
+    app.config['SMTP_USERNAME'],
+    app.config['SMTP_PASSWORD'],
+    max_messages=app.config['SMTP_MAX_MESSAGES_PER_CONNECTION']
+)
 
 # Initialize AI clients
-openai.api_key = app.config['OPENAI_API_KEY']
-anthropic_client = anthropic.Anthropic(api_key=app.config['ANTHROPIC_API_KEY'])
-genai.configure(api_key=app.config['GOOGLE_AI_API_KEY'])
-
-# Initialize scheduler
-jobstores = {
-    'default': SQLAlchemyJobStore(url='sqlite:///jobs.sqlite')
-}
-executors = {
-    'default': ThreadPoolExecutor(20)
-}
-job_defaults = {
-    'coalesce': False,
-    'max_instances': 3
-}
-scheduler = BackgroundScheduler(jobstores=jobstores, executors=executors, job_defaults=job_defaults)
-scheduler.start()
-
-def token_required(f):
-    @wraps(f)
-    def decorated(*args, **kwargs):
-        token = request.headers.get('Authorization')
-        if not token:
-            return jsonify({'message': 'Token is missing!'}), 401
-        try:
-            data = jwt.decode(token, app.config['JWT_SECRET'], algorithms=["HS256"])
-        except:
-            return jsonify({'message': 'Token is invalid!'}), 401
-        return f(data['user_id'], *args, **kwargs)
-    return decorated
-
-def get_hasura_client():
-    headers = {
-        'Content-Type': 'application/json',
-        'X-Hasura-Admin-Secret': app.config['HASURA_ADMIN_SECRET']
-    }
-    return app.config['HASURA_ENDPOINT'], headers
-
-def execute_hasura_query(query, variables=None):
-    endpoint, headers = get_hasura_client()
-    response = requests.post(endpoint, json={'query': query, 'variables': variables}, headers=headers)
-    response.raise_for_status()
-    return response.json()
+llm_providers.configure(
+    openai=app.config['OPENAI_API_KEY'],
+    anthropic=app.config['ANTHROPIC_API_KEY'],
+    google=app.config['GOOGLE_AI_API_KEY']
+)
+
+# Shared pool for running the AI advisors concurrently
+advisor_executor = concurrent.futures.ThreadPoolExecutor(max_workers=app.config['ADVISOR_WORKERS'])
+# Scheduled replays wait on advisor_executor, so they get a pool of their own
+replay_executor = concurrent.futures.ThreadPoolExecutor(max_workers=app.config['REPLAY_WORKERS'])
+# Caps replays queued or running; a job that fires while the pool is
+# saturated skips its refresh rather than growing the backlog without bound
+replay_slots = threading.BoundedSemaphore(app.config['REPLAY_QUEUE_SIZE'])
 
 @app.route('/')
 def hello():
@@ -85,18 +82,13 @@ def register():
     if not data or not data.get('email') or not data.get('password'):
         return jsonify({'message': 'Invalid input'}), 400
 
-    query = """
-    mutation ($email: String!, $password: String!) {
-      insert_users_one(object: {email: $email, password: $password}) {
-        id
-      }
-    }
-    """
     variables = {'email': data['email'], 'password': data['password']}
     
     try:
-        result = execute_hasura_query(query, variables)
-        return jsonify({'message': 'User created successfully', 'user_id': result['data']['insert_users_one']['id']}), 201
+        result = hasura.execute_operation('CreateUser', variables)
+        user_id = result['data']['insert_users_one']['id']
+        user_email_cache.invalidate(user_id)
+        return jsonify({'message': 'User created successfully', 'user_id': user_id}), 201
     except Exception as e:
         return jsonify({'message': 'Error creating user', 'error': str(e)}), 500
 
@@ -106,17 +98,10 @@ def login():
     if not auth or not auth.get('email') or not auth.get('password'):
         return jsonify({'message': 'Could not verify'}), 401
 
-    query = """
-    query ($email: String!, $password: String!) {
-      users(where: {email: {_eq: $email}, password: {_eq: $password}}) {
-        id
-      }
-    }
-    """
     variables = {'email': auth['email'], 'password': auth['password']}
     
     try:
-        result = execute_hasura_query(query, variables)
+        result = hasura.execute_operation('FindUserByCredentials', variables)
         if result['data']['users']:
             token = jwt.encode({
                 'user_id': result['data']['users'][0]['id'],
@@ -141,95 +126,118 @@ def create_task(user_id):
     }
 
     # Process the task through our services
-    breakdown = process_task_breakdown(task)
-    time_management = process_time_management(task)
-    focus_techniques = process_focus_techniques(task)
-    learning_strategies = process_learning_strategies(task)
-    emotional_regulation = process_emotional_regulation(task)
+    mode = data.get('mode', 'auto')
+    if mode not in ('auto', 'combined', 'separate'):
+        return jsonify({'message': 'Invalid mode'}), 400
+    if mode == 'auto':
+        mode = 'combined' if len(task['content']) <= app.config['COMBINED_MODE_MAX_CHARS'] else 'separate'
+
+    # Both the combined call and any fallback fit in one TASK_BUDGET
+    start = time.monotonic()
+    advisor_results = None
+    if mode == 'combined':
+        advisor_results = run_combined_advisor(task)
+    if advisor_results is not None:
+        pending, failed = [], []
+    else:
+        advisor_results, pending, failed = run_advisors(task, budget=app.config['TASK_BUDGET'] - (time.monotonic() - start))
 
     # Combine results
     result = {
         'task_id': task['id'],
         'user_id': user_id,
         'content': task['content'],
-        'task_breakdown': breakdown,
-        'time_management': time_management,
-        'focus_techniques': focus_techniques,
-        'learning_strategies': learning_strategies,
-        'emotional_regulation': emotional_regulation
+        **advisor_results
     }
 
     # Save the result to the database
-    query = """
-    mutation ($task: tasks_insert_input!) {
-      insert_tasks_one(object: $task) {
-        id
-      }
-    }
-    """
     variables = {'task': result}
     
     try:
-        execute_hasura_query(query, variables)
-        return jsonify(result), 201
+        hasura.execute_operation('InsertTask', variables)
+        return jsonify({**result, 'pending': pending, 'failed': failed}), 201
     except Exception as e:
         return jsonify({'message': 'Error saving task', 'error': str(e)}), 500
 
-def process_task_breakdown(task):
-    response = openai.ChatCompletion.create(
-        model="gpt-4",
-        messages=[
-            {"role": "system", "content": "You are a helpful assistant that breaks down tasks for people with ADHD."},
-            {"role": "user", "content": f"Break down this task into manageable steps: {task['content']}"}
-        ]
-    )
-    return response.choices[0].message['content'].strip().split('\n')
-
-def process_time_management(task):
-    response = anthropic_client.completions.create(
-        model="claude-3-sonnet-20240229",
-        max_tokens=300,
-        prompt=f"Human: Provide a time management strategy for the following task: {task['content']}\n\nAssistant:"
-    )
-    return response.completion.strip()
-
-def process_focus_techniques(task):
-    model = genai.GenerativeModel('gemini-pro')
-    response = model.generate_content(f"Suggest focus techniques for someone with ADHD to complete this task: {task['content']}")
-    return response.text.strip()
-
-def process_learning_strategies(task):
-    response = openai.ChatCompletion.create(
-        model="gpt-4",
-        messages=[
-            {"role": "system", "content": "You are a helpful assistant that provides learning strategies for people with ADHD."},
-            {"role": "user", "content": f"Suggest learning strategies for someone with ADHD to learn about: {task['content']}"}
-        ]
-    )
-    return response.choices[0].message['content'].strip()
-
-def process_emotional_regulation(task):
-    response = anthropic_client.completions.create(
-        model="claude-3-sonnet-20240229",
-        max_tokens=300,
-        prompt=f"Human: Suggest emotional regulation strategies for someone with ADHD dealing with: {task['content']}\n\nAssistant:"
-    )
-    return response.completion.strip()
+def run_combined_advisor(task):
+    # One structured request answers all five advisors; if it fails or comes
+    # back incomplete the caller falls back to the concurrent fan-out with
+    # whatever is left of the task budget. A timed-out call is cancelled.
+    try:
+        return llm_router.advise_combined_sync(task['content'], timeout=min(app.config['ADVISOR_TIMEOUT'], app.config['TASK_BUDGET']))
+    except Exception as e:
+        print(f"Combined advisor failed for task {task['id']}, falling back to separate advisors: {str(e)}")
+        return None
+
+def run_advisors(task, advisors=None, budget=None):
+    # Fan the task out to every advisor at once. Each advisor gets its own
+    # deadline, capped by the remaining request budget (all of TASK_BUDGET
+    # unless the caller already spent some); anything still running when its
+    # deadline passes is reported as pending rather than awaited. Advisors
+    # give up at the same deadline and cancel their provider call, and ones
+    # still queued are cancelled, so pending work does not hold pool threads.
+    advisors = advisors or ADVISORS
+    start = time.monotonic()
+    budget_deadline = start + max(0, app.config['TASK_BUDGET'] if budget is None else budget)
+    advisor_deadline = min(start + app.config['ADVISOR_TIMEOUT'], budget_deadline)
+
+    futures = {name: advisor_executor.submit(fn, task, advisor_deadline) for name, fn in advisors.items()}
+
+    results, pending, failed = {}, [], []
+    for name, future in futures.items():
+        try:
+            results[name] = future.result(timeout=max(0, advisor_deadline - time.monotonic()))
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            results[name] = None
+            pending.append(name)
+        except Exception as e:
+            print(f"Advisor {name} failed for task {task['id']}: {str(e)}")
+            results[name] = None
+            failed.append(name)
+    return results, pending, failed
+
+# Each advisor is requested by capability; llm_router picks the provider,
+# hedges slow calls and fails over on errors. `deadline` is a time.monotonic()
+# value after which the call is abandoned.
+def remaining(deadline):
+    return None if deadline is None else max(0, deadline - time.monotonic())
+
+def process_task_breakdown(task, deadline=None):
+    return llm_router.advise_sync('task_breakdown', task['content'], timeout=remaining(deadline))
+
+def process_time_management(task, deadline=None):
+    return llm_router.advise_sync('time_management', task['content'], timeout=remaining(deadline))
+
+def process_focus_techniques(task, deadline=None):
+    return llm_router.advise_sync('focus_techniques', task['content'], timeout=remaining(deadline))
+
+def process_learning_strategies(task, deadline=None):
+    return llm_router.advise_sync('learning_strategies', task['content'], timeout=remaining(deadline))
+
+def process_emotional_regulation(task, deadline=None):
+    return llm_router.advise_sync('emotional_regulation', task['content'], timeout=remaining(deadline))
+
+ADVISORS = {
+    'task_breakdown': process_task_breakdown,
+    'time_management': process_time_management,
+    'focus_techniques': process_focus_techniques,
+    'learning_strategies': process_learning_strategies,
+    'emotional_regulation': process_emotional_regulation
+}
 
 @app.route('/schedule', methods=['POST'])
 @token_required
 def schedule(user_id):
     data = request.json
-    if not data or not data.get('task_id') or not data.get('schedule_time'):
+    if not data or not data.get('task_id') or not (data.get('schedule_time') or data.get('trigger')):
         return jsonify({'message': 'Invalid input'}), 400
 
-    scheduler.add_job(
-        trigger_task, 
-        'date', 
-        run_date=data['schedule_time'], 
-        args=[data['task_id']], 
-        id=data['task_id']
-    )
+    result = scheduler.apply_requests([dict(data, op='schedule')], user_id)[0]
+    if result['status'] == 'invalid':
+        return jsonify({'message': 'Invalid schedule', 'error': result['error']}), 400
+    if result['status'] == 'conflict':
+        return jsonify({'message': 'Task is already scheduled'}), 409
 
     return jsonify({'message': 'Task scheduled successfully'}), 200
 
@@ -237,14 +245,14 @@ def schedule(user_id):
 @token_required
 def reschedule(user_id):
     data = request.json
-    if not data or not data.get('task_id') or not data.get('new_schedule_time'):
+    if not data or not data.get('task_id') or not (data.get('new_schedule_time') or data.get('trigger')):
         return jsonify({'message': 'Invalid input'}), 400
 
-    scheduler.reschedule_job(
-        data['task_id'], 
-        trigger='date', 
-        run_date=data['new_schedule_time']
-    )
+    result = scheduler.apply_requests([dict(data, op='reschedule')], user_id)[0]
+    if result['status'] == 'invalid':
+        return jsonify({'message': 'Invalid schedule', 'error': result['error']}), 400
+    if result['status'] == 'not_found':
+        return jsonify({'message': 'Scheduled task not found'}), 404
 
     return jsonify({'message': 'Task rescheduled successfully'}), 200
 
@@ -255,36 +263,99 @@ def cancel(user_id):
     if not data or not data.get('task_id'):
         return jsonify({'message': 'Invalid input'}), 400
 
-    scheduler.remove_job(data['task_id'])
+    if not scheduler.remove(data['task_id'], owner=user_id):
+        return jsonify({'message': 'Scheduled task not found'}), 404
 
     return jsonify({'message': 'Task cancelled successfully'}), 200
 
-def trigger_task(task_id):
-    query = """
-    query ($task_id: uuid!) {
-      tasks_by_pk(id: $task_id) {
-        id
-        user_id
-        content
-      }
+@app.route('/schedule/batch', methods=['POST'])
+@token_required
+def schedule_batch(user_id):
+    # {"operations": [{"op": "schedule" | "reschedule" | "cancel", "task_id": ..., ...}]},
+    # applied in one job-store transaction with a status per operation
+    data = request.json
+    operations = data.get('operations') if data else None
+    if not isinstance(operations, list) or not operations:
+        return jsonify({'message': 'Invalid input'}), 400
+    if len(operations) > app.config['MAX_SCHEDULE_BATCH']:
+        return jsonify({'message': f"At most {app.config['MAX_SCHEDULE_BATCH']} operations per batch"}), 400
+
+    return jsonify({'results': scheduler.apply_requests(operations, user_id)}), 200
+
+def fetch_tasks(task_ids):
+    # {task_id: task} for every id Hasura can resolve. If the query itself is
+    # rejected (e.g. a malformed id) each id is looked up alone so a bad one
+    # only drops itself; transport errors still raise so the batch is retried.
+    result = hasura.execute_operation('TasksByIds', {'task_ids': task_ids})
+    if not result.get('errors'):
+        return {task['id']: task for task in result['data']['tasks']}
+    if len(task_ids) == 1:
+        print(f"Could not resolve scheduled task {task_ids[0]}: {result['errors']}")
+        return {}
+    tasks = {}
+    for task_id in task_ids:
+        tasks.update(fetch_tasks([task_id]))
+    return tasks
+
+def replay_task(task):
+    # Refresh the scheduled task's advice off the dispatcher thread and keep
+    # the latest answers in task_results
+    start = time.monotonic()
+    advisor_results = run_combined_advisor(task)
+    status = 'completed'
+    if advisor_results is None:
+        advisor_results, pending, failed = run_advisors(task, budget=app.config['TASK_BUDGET'] - (time.monotonic() - start))
+        if pending or failed:
+            status = 'partial'
+    result = {
+        'task_id': task['id'],
+        'user_id': task['user_id'],
+        'status': status,
+        'results': json.dumps(advisor_results)
     }
-    """
-    variables = {'task_id': task_id}
-    
     try:
-        result = execute_hasura_query(query, variables)
-        task = result['data']['tasks_by_pk']
-        if task:
-            # Process the task
-            create_task(task['user_id'])
-            # Send notification
+        hasura.execute_operation('UpsertTaskResult', {'result': result})
+    except Exception as e:
+        print(f"Error saving replayed task {task['id']}: {str(e)}")
+
+def run_due_jobs(jobs):
+    # Called by the scheduler with every job due in the current window: one
+    # Hasura query for all of their tasks, then the reminders go onto the
+    # notification queue and the advice refreshes onto the replay pool, so
+    # the dispatcher itself never waits on an LLM or SMTP. Jobs whose task
+    # cannot be resolved are returned so the scheduler deletes them.
+    tasks = fetch_tasks(list({job['task_id'] for job in jobs}))
+    dropped = []
+    for job in jobs:
+        task = tasks.get(job['task_id'])
+        if task is None:
+            print(f"Scheduled task not found, dropping job: {job['task_id']}")
+            dropped.append(job['id'])
+            continue
+        if job.get('user_id') != task['user_id']:
+            # Only a task's owner may schedule it; anyone else's job would
+            # mail the owner and spend LLM budget on their content
+            print(f"Scheduled task {job['task_id']} belongs to another user, dropping job")
+            dropped.append(job['id'])
+            continue
+        try:
             create_notification({
                 'user_id': task['user_id'],
                 'subject': 'Task Reminder',
                 'body': f"Don't forget to work on your task: {task['content']}"
             })
-    except Exception as e:
-        print(f"Error triggering task: {str(e)}")
+        except queue.Full:
+            print(f"Notification queue full, dropping reminder for task {task['id']}")
+        if not replay_slots.acquire(blocking=False):
+            print(f"Replay pool saturated, skipping advice refresh for task {task['id']}")
+            continue
+        replay_executor.submit(replay_task, task).add_done_callback(lambda _: replay_slots.release())
+    return dropped
+
+# Jobs live in Redis and are claimed under a lease, so every gunicorn worker
+# and replica can run the dispatcher and each job still fires once
+scheduler = RedisScheduler(run_due_jobs)
+scheduler.start()
 
 @app.route('/notify', methods=['POST'])
 @token_required
@@ -294,45 +365,62 @@ def notify(user_id):
         return jsonify({'message': 'Invalid input'}), 400
 
     data['user_id'] = user_id
-    return create_notification(data)
+    try:
+        delivery_id = create_notification(data)
+    except queue.Full:
+        return jsonify({'message': 'Notification queue is full, try again later'}), 503, {'Retry-After': '5'}
+    return jsonify({
+        'message': 'Notification queued',
+        'delivery_id': delivery_id,
+        'status_url': f"/notifications/{delivery_id}"
+    }), 202
+
+@app.route('/notifications/<delivery_id>', methods=['GET'])
+@token_required
+def notification_status(user_id, delivery_id):
+    status = notifications.status(delivery_id)
+    if status is None or status['owner'] != user_id:
+        return jsonify({'message': 'Delivery not found'}), 404
+    return jsonify({key: value for key, value in status.items() if key != 'owner'}), 200
 
 def create_notification(data):
-    # Get user email
-    query = """
-    query ($user_id: uuid!) {
-      users_by_pk(id: $user_id) {
-        email
-      }
-    }
-    """
-    variables = {'user_id': data['user_id']}
-    
-    try:
-        result = execute_hasura_query(query, variables)
-        user = result['data']['users_by_pk']
-        if user:
-            send_email(user['email'], data['subject'], data['body'])
-            return jsonify({'message': 'Notification sent successfully'}), 200
-        else:
-            return jsonify({'message': 'User not found'}), 404
-    except Exception as e:
-        return jsonify({'message': 'Error sending notification', 'error': str(e)}), 500
+    # Queued for the notification workers; raises queue.Full when the
+    # backlog is at NOTIFY_QUEUE_SIZE
+    return notifications.submit(data, owner=data['user_id'])
 
-def send_email(to_email, subject, body):
+def build_email(to_email, subject, body):
     msg = EmailMessage()
     msg.set_content(body)
     msg['Subject'] = subject
     msg['From'] = app.config['SMTP_USERNAME']
     msg['To'] = to_email
-
-    with smtplib.SMTP(app.config['SMTP_SERVER'], app.config['SMTP_PORT']) as server:
-        server.starttls()
-        server.login(app.config['SMTP_USERNAME'], app.config['SMTP_PASSWORD'])
-        server.send_message(msg)
+    return msg
+
+def deliver_notifications(batch):
+    # Runs on a notification worker: one recipient lookup and one pooled
+    # SMTP session for the whole batch
+    emails = user_email_cache.lookup_many(hasura, [data['user_id'] for data in batch])
+    errors = [None if emails[data['user_id']] else Exception('User not found') for data in batch]
+    outgoing = [i for i, error in enumerate(errors) if error is None]
+    results = smtp.send_many([
+        build_email(emails[batch[i]['user_id']], batch[i]['subject'], batch[i]['body'])
+        for i in outgoing
+    ])
+    for i, error in zip(outgoing, results):
+        errors[i] = error
+    return errors
+
+notifications = DeliveryQueue(
+    deliver_notifications,
+    workers=app.config['NOTIFY_WORKERS'],
+    maxsize=app.config['NOTIFY_QUEUE_SIZE'],
+    batch_size=app.config['NOTIFY_BATCH_SIZE'],
+    name='notification'
+)
 
 @app.route('/health')
 def health():
-    return jsonify({"status": "healthy"}), 200
+    return jsonify({"status": "healthy", "llm_cache": llm_cache.stats(), "auth": auth.stats(), "hasura": hasura.metrics(), "llm_routes": llm_router.router.summary(), "llm_budget": llm_router.router.budget.stats(), "smtp": smtp.stats(), "user_email_cache": user_email_cache.stats(), "notifications": notifications.stats(), "scheduler": scheduler.stats()}), 200
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8080))
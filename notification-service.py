@@ -1,75 +1,125 @@
 # Microservices/NotificationService.py
 
 from flask import Flask, request, jsonify
-import requests
 import os
 import pika
 import json
+import time
+import uuid
 from email.message import EmailMessage
-import smtplib
+from rabbitmq_pool import PublisherPool
+from hasura_client import HasuraClient
+from reliable_consumer import ReliableConsumer, DONE, IN_PROGRESS
+from smtp_pool import SMTPPool
+import user_email_cache
 
 app = Flask(__name__)
 
+publisher = PublisherPool(queues=['notification_queue'])
+hasura = HasuraClient()
+smtp = SMTPPool()
+
+NOTIFICATION_BATCH_SIZE = int(os.getenv('NOTIFICATION_BATCH_SIZE', 50))
+NOTIFICATION_FLUSH_MS = int(os.getenv('NOTIFICATION_FLUSH_MS', 500))
+
 def connect_rabbitmq():
     credentials = pika.PlainCredentials(os.getenv('RABBITMQ_USER'), os.getenv('RABBITMQ_PASS'))
     connection = pika.BlockingConnection(pika.ConnectionParameters(host=os.getenv('RABBITMQ_HOST'), credentials=credentials))
     return connection
 
-def get_hasura_client():
-    hasura_endpoint = os.getenv('HASURA_GRAPHQL_ENDPOINT')
-    hasura_admin_secret = os.getenv('HASURA_ADMIN_SECRET')
-    
-    headers = {
-        'Content-Type': 'application/json',
-        'X-Hasura-Admin-Secret': hasura_admin_secret
-    }
-    return hasura_endpoint, headers
 
-def send_email(to_email, subject, body):
+def parse_notification(body):
+    # Raises ValueError for anything deliver_batch could not send, so it is
+    # dead-lettered up front instead of failing a whole batch later
+    notification = json.loads(body)
+    if not isinstance(notification, dict):
+        raise ValueError('Notification must be a JSON object')
+    for field in ('user_id', 'subject', 'body'):
+        if not isinstance(notification.get(field), str) or not notification[field]:
+            raise ValueError(f"Notification is missing {field}")
+    return notification
+
+def build_email(to_email, subject, body):
     msg = EmailMessage()
     msg.set_content(body)
     msg['Subject'] = subject
     msg['From'] = os.getenv('EMAIL_FROM')
     msg['To'] = to_email
+    return msg
 
-    # Send the message via SMTP server
-    with smtplib.SMTP(os.getenv('SMTP_SERVER'), os.getenv('SMTP_PORT')) as s:
-        s.starttls()
-        s.login(os.getenv('SMTP_USERNAME'), os.getenv('SMTP_PASSWORD'))
-        s.send_message(msg)
+def deliver_batch(consumer, deliveries):
+    """Send a batch of claimed notifications over pooled SMTP sessions and
+    ack or retry each delivery according to its own outcome."""
+    try:
+        # One query for every recipient the cache does not already know
+        emails = user_email_cache.lookup_many(hasura, [notification['user_id'] for *_, notification in deliveries])
+    except Exception as e:
+        print(f"Error looking up notification recipients: {str(e)}")
+        for method, properties, body, _ in deliveries:
+            consumer.release(properties.message_id)
+            consumer.fail(method, properties, body, e)
+        return
 
-def process_notification(notification):
-    hasura_endpoint, headers = get_hasura_client()
-    
-    query = """
-    query ($user_id: uuid!) {
-      users_by_pk(id: $user_id) {
-        email
-      }
-    }
-    """
-    variables = {'user_id': notification['user_id']}
-    response = requests.post(hasura_endpoint, json={'query': query, 'variables': variables}, headers=headers)
-    user = response.json()['data']['users_by_pk']
-    
-    if user:
-        send_email(user['email'], notification['subject'], notification['body'])
-        print(f"Sent email notification to user: {notification['user_id']}")
-    else:
-        print(f"User not found: {notification['user_id']}")
+    outgoing = []
+    for method, properties, body, notification in deliveries:
+        email = emails[notification['user_id']]
+        if not email:
+            print(f"User not found: {notification['user_id']}")
+            consumer.complete(properties.message_id)
+            consumer.ack(method.delivery_tag)
+            continue
+        outgoing.append((method, properties, body, notification, build_email(email, notification['subject'], notification['body'])))
+
+    results = smtp.send_many([msg for *_, msg in outgoing])
+    for (method, properties, body, notification, _), error in zip(outgoing, results):
+        if error is None:
+            consumer.complete(properties.message_id)
+            consumer.ack(method.delivery_tag)
+        else:
+            print(f"Error sending notification to user {notification['user_id']}: {str(error)}")
+            consumer.release(properties.message_id)
+            consumer.fail(method, properties, body, error)
+    print(f"Sent {results.count(None)} of {len(outgoing)} email notifications")
 
 def main():
     connection = connect_rabbitmq()
     channel = connection.channel()
-    channel.queue_declare(queue='notification_queue')
+    channel.queue_declare(queue='notification_queue', durable=True)
+    channel.basic_qos(prefetch_count=NOTIFICATION_BATCH_SIZE * 2)
+    consumer = ReliableConsumer(channel, 'notification_queue')
 
-    def callback(ch, method, properties, body):
-        notification = json.loads(body)
-        process_notification(notification)
+    flush_interval = NOTIFICATION_FLUSH_MS / 1000.0
+    batch = []
+    flush_deadline = None
 
-    channel.basic_consume(queue='notification_queue', on_message_callback=callback, auto_ack=True)
     print('Notification Service waiting for messages...')
-    channel.start_consuming()
+    for method, properties, body in channel.consume('notification_queue', inactivity_timeout=flush_interval):
+        if method is not None:
+            consumer.received(method, properties)
+            # Keyed on the message id assigned at /notify, so a redelivery
+            # after the email went out does not send it twice
+            try:
+                notification = parse_notification(body)
+            except ValueError as e:
+                consumer.fail(method, properties, body, e, permanent=True)
+                notification = None
+            if notification is not None:
+                state = consumer.claim(properties.message_id)
+                if state == DONE:
+                    consumer.ack(method.delivery_tag)
+                    notification = None
+                elif state == IN_PROGRESS:
+                    # Another attempt holds the key, possibly one that crashed
+                    consumer.defer(method, properties, body)
+                    notification = None
+            if notification is not None:
+                if not batch:
+                    flush_deadline = time.monotonic() + flush_interval
+                batch.append((method, properties, body, notification))
+
+        if batch and (len(batch) >= NOTIFICATION_BATCH_SIZE or time.monotonic() >= flush_deadline):
+            deliver_batch(consumer, batch)
+            batch = []
 
 @app.route('/notify', methods=['POST'])
 def create_notification():
@@ -77,11 +127,7 @@ def create_notification():
     if not data or not data.get('user_id') or not data.get('subject') or not data.get('body'):
         return jsonify({'message': 'Invalid input'}), 400
 
-    connection = connect_rabbitmq()
-    channel = connection.channel()
-    channel.queue_declare(queue='notification_queue')
-    channel.basic_publish(exchange='', routing_key='notification_queue', body=json.dumps(data))
-    connection.close()
+    publisher.publish('', 'notification_queue', json.dumps(data), pika.BasicProperties(message_id=str(uuid.uuid4()), delivery_mode=2))
 
     return jsonify({'message': 'Notification queued successfully'}), 200
 
@@ -89,6 +135,7 @@ if __name__ == '__main__':
     # Run the RabbitMQ consumer in a separate thread
     import threading
     threading.Thread(target=main, daemon=True).start()
+    user_email_cache.listen_for_invalidations()
     
     # Run the Flask app
     app.run(host='0.0.0.0', port=5002)
@@ -0,0 +1,154 @@
+# password_hashing.py
+
+import concurrent.futures
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import time
+from collections import deque
+from werkzeug.security import check_password_hash
+
+SCRYPT_N = int(os.getenv('PASSWORD_SCRYPT_N', 2 ** 15))
+SCRYPT_R = int(os.getenv('PASSWORD_SCRYPT_R', 8))
+SCRYPT_P = int(os.getenv('PASSWORD_SCRYPT_P', 1))
+SALT_BYTES = 16
+STATS_WINDOW = int(os.getenv('PASSWORD_HASH_STATS_WINDOW', 500))
+# Background rehashes are skipped once the queue is this full
+REHASH_MAX_LOAD = float(os.getenv('PASSWORD_REHASH_MAX_LOAD', 0.5))
+
+class HashQueueFull(Exception):
+    pass
+
+def _scrypt(password, salt, n, r, p):
+    # maxmem must cover 128 * n * r bytes, plus headroom
+    return hashlib.scrypt(password.encode('utf-8'), salt=salt.encode('utf-8'), n=n, r=r, p=p, maxmem=256 * n * r + 1024 * 1024, dklen=64).hex()
+
+def hash_password(password, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P):
+    """scrypt hash in werkzeug's `scrypt:n:r:p$salt$hash` format."""
+    start = time.perf_counter()
+    salt = secrets.token_hex(SALT_BYTES)
+    digest = _scrypt(password, salt, n, r, p)
+    return f"scrypt:{n}:{r}:{p}${salt}${digest}", time.perf_counter() - start
+
+def verify_password(stored, password):
+    start = time.perf_counter()
+    if stored.startswith('scrypt:'):
+        method, salt, digest = stored.split('$', 2)
+        n, r, p = (int(value) for value in method.split(':')[1:])
+        valid = hmac.compare_digest(_scrypt(password, salt, n, r, p), digest)
+    else:
+        # Hashes from before the switch to scrypt (werkzeug sha256/pbkdf2)
+        valid = check_password_hash(stored, password)
+    return valid, time.perf_counter() - start
+
+def needs_rehash(stored, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P):
+    return not stored.startswith(f"scrypt:{n}:{r}:{p}$")
+
+class PasswordHasher:
+    """Runs password hashing in a process pool so it neither blocks request
+    threads nor serializes on the GIL.
+
+    At most `max_pending` hashes may be queued or running; beyond that
+    `hash`/`verify` raise HashQueueFull immediately so callers can shed load
+    instead of piling up. The pool is created on first use, after any
+    gunicorn fork.
+
+    `rehash` upgrades a stored hash off the request path. Upgrades only use
+    spare capacity: they are skipped while the queue is more than
+    REHASH_MAX_LOAD full or `workers` of them are already outstanding, and
+    simply happen on a later login instead.
+    """
+
+    def __init__(self, workers=None, max_pending=None):
+        self.workers = workers or int(os.getenv('PASSWORD_HASH_WORKERS', os.cpu_count() or 1))
+        self.max_pending = max_pending or int(os.getenv('PASSWORD_HASH_QUEUE', self.workers * 8))
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._executor = None
+        self._rehashes = threading.BoundedSemaphore(self.workers)
+        self._rehash_executor = None
+        self.hash_times = deque(maxlen=STATS_WINDOW)
+        self.wait_times = deque(maxlen=STATS_WINDOW)
+        self.counts = {'hashed': 0, 'verified': 0, 'rejected': 0, 'rehashed': 0, 'rehash_skipped': 0}
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+            return self._executor
+
+    def _background(self):
+        with self._lock:
+            if self._rehash_executor is None:
+                self._rehash_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='rehash')
+            return self._rehash_executor
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            self.counts['rejected'] += 1
+            raise HashQueueFull('Password hashing queue is full')
+        with self._lock:
+            self._pending += 1
+        start = time.perf_counter()
+        try:
+            result, elapsed = self._pool().submit(fn, *args).result()
+        finally:
+            with self._lock:
+                self._pending -= 1
+            self._slots.release()
+        self.hash_times.append(elapsed)
+        self.wait_times.append(time.perf_counter() - start - elapsed)
+        return result
+
+    def hash(self, password):
+        result = self._run(hash_password, password)
+        self.counts['hashed'] += 1
+        return result
+
+    def verify(self, stored, password):
+        result = self._run(verify_password, stored, password)
+        self.counts['verified'] += 1
+        return result
+
+    def needs_rehash(self, stored):
+        return needs_rehash(stored)
+
+    def rehash(self, password, save):
+        """Hash `password` in the background and hand the result to
+        `save(hashed)`; returns False if the upgrade was skipped."""
+        if self._pending >= self.max_pending * REHASH_MAX_LOAD or not self._rehashes.acquire(blocking=False):
+            self.counts['rehash_skipped'] += 1
+            return False
+        self._background().submit(self._rehash, password, save)
+        return True
+
+    def _rehash(self, password, save):
+        try:
+            save(self.hash(password))
+            self.counts['rehashed'] += 1
+        except Exception as e:
+            # The old hash still works; the next login tries again
+            print(f"Error rehashing password: {str(e)}")
+        finally:
+            self._rehashes.release()
+
+    def stats(self):
+        def percentile(samples, p):
+            if not samples:
+                return None
+            ordered = sorted(samples)
+            return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+        return dict(
+            self.counts,
+            scheme=f"scrypt:{SCRYPT_N}:{SCRYPT_R}:{SCRYPT_P}",
+            workers=self.workers,
+            queue_depth=self._pending,
+            queue_capacity=self.max_pending,
+            hash_time_p50=percentile(self.hash_times, 0.5),
+            hash_time_p95=percentile(self.hash_times, 0.95),
+            queue_wait_p95=percentile(self.wait_times, 0.95)
+        )
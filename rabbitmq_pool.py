@@ -0,0 +1,130 @@
+# rabbitmq_pool.py
+
+import os
+import queue
+import threading
+from contextlib import contextmanager
+import pika
+from pika.exceptions import AMQPConnectionError, AMQPChannelError
+
+def connection_parameters():
+    credentials = pika.PlainCredentials(os.getenv('RABBITMQ_USER'), os.getenv('RABBITMQ_PASS'))
+    return pika.ConnectionParameters(
+        host=os.getenv('RABBITMQ_HOST'),
+        credentials=credentials,
+        heartbeat=int(os.getenv('RABBITMQ_HEARTBEAT', 60)),
+        blocked_connection_timeout=int(os.getenv('RABBITMQ_BLOCKED_TIMEOUT', 30))
+    )
+
+class PublisherPool:
+    """Long-lived, thread-safe pool of confirming publisher channels.
+
+    Each slot owns one BlockingConnection and one channel. A slot is checked
+    out by exactly one thread at a time, connected lazily, and replaced when
+    the broker drops it. Queues, and any extra topology such as exchanges and
+    bindings, are declared once per pool rather than per publish.
+    """
+
+    def __init__(self, queues=(), topology=None, size=None, parameters=None, checkout_timeout=None):
+        self.queues = list(queues)
+        self.topology = topology
+        self.size = size or int(os.getenv('RABBITMQ_POOL_SIZE', 4))
+        self.parameters = parameters or connection_parameters()
+        self.checkout_timeout = checkout_timeout or float(os.getenv('RABBITMQ_POOL_TIMEOUT', 5))
+        self._slots = queue.LifoQueue(maxsize=self.size)
+        for _ in range(self.size):
+            self._slots.put(None)
+        self._declared = False
+        self._declare_lock = threading.Lock()
+
+    def _open(self):
+        connection = pika.BlockingConnection(self.parameters)
+        channel = connection.channel()
+        channel.confirm_delivery()
+        self._declare(channel)
+        return connection, channel
+
+    def _declare(self, channel):
+        with self._declare_lock:
+            if self._declared:
+                return
+            self.declare_topology(channel)
+            self._declared = True
+
+    def declare_topology(self, channel):
+        for name in self.queues:
+            channel.queue_declare(queue=name, durable=True)
+        if self.topology is not None:
+            self.topology(channel)
+
+    def _close(self, slot):
+        if slot is None:
+            return
+        try:
+            if slot[0].is_open:
+                slot[0].close()
+        except Exception:
+            pass
+
+    @contextmanager
+    def channel(self):
+        try:
+            slot = self._slots.get(timeout=self.checkout_timeout)
+        except queue.Empty:
+            raise AMQPConnectionError('Timed out waiting for a pooled RabbitMQ channel')
+        try:
+            if slot is not None:
+                try:
+                    # Service heartbeats that arrived while the slot sat idle
+                    slot[0].process_data_events(time_limit=0)
+                except AMQPConnectionError:
+                    self._close(slot)
+                    slot = None
+            if slot is None or slot[0].is_closed or slot[1].is_closed:
+                self._close(slot)
+                slot = self._open()
+            yield slot[1]
+        except (AMQPConnectionError, AMQPChannelError):
+            self._close(slot)
+            slot = None
+            raise
+        finally:
+            self._slots.put(slot)
+
+    def publish(self, exchange, routing_key, body, properties=None, retries=1):
+        # With publisher confirms enabled, basic_publish blocks until the broker
+        # acks the message and raises if it is nacked.
+        for attempt in range(retries + 1):
+            try:
+                with self.channel() as channel:
+                    channel.basic_publish(exchange=exchange, routing_key=routing_key, body=body, properties=properties)
+                return
+            except (AMQPConnectionError, AMQPChannelError) as e:
+                if attempt == retries:
+                    raise
+                print(f"RabbitMQ publish failed, reconnecting: {str(e)}")
+
+    def publish_many(self, messages, retries=1):
+        # (exchange, routing_key, body, properties) tuples over one checked-out
+        # channel; if the connection drops part way, only the unpublished
+        # remainder is retried on a fresh one.
+        sent = 0
+        for attempt in range(retries + 1):
+            try:
+                with self.channel() as channel:
+                    while sent < len(messages):
+                        exchange, routing_key, body, properties = messages[sent]
+                        channel.basic_publish(exchange=exchange, routing_key=routing_key, body=body, properties=properties)
+                        sent += 1
+                return
+            except (AMQPConnectionError, AMQPChannelError) as e:
+                if attempt == retries:
+                    raise
+                print(f"RabbitMQ batch publish failed after {sent} of {len(messages)}, reconnecting: {str(e)}")
+
+    def close(self):
+        while True:
+            try:
+                self._close(self._slots.get_nowait())
+            except queue.Empty:
+                break
@@ -0,0 +1,309 @@
+# reliable_consumer.py
+
+import asyncio
+import os
+import time
+import aio_pika
+import pika
+from ttl_cache import TTLCache, MISSING
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# One retry queue per backoff step; a failed delivery waits out the step's
+# TTL in its retry queue and is then dead-lettered back onto the work queue.
+RETRY_DELAYS_MS = [int(delay) for delay in os.getenv('CONSUMER_RETRY_DELAYS_MS', '1000,5000,30000,120000').split(',')]
+RETRY_HEADER = 'x-retry-count'
+ERROR_HEADER = 'x-last-error'
+DEAD_LETTER_EXCHANGE = 'dead_letter'
+IDEMPOTENCY_TTL = int(os.getenv('IDEMPOTENCY_TTL', 86400))
+IDEMPOTENCY_LEASE = int(os.getenv('IDEMPOTENCY_LEASE', 600))
+METRICS_INTERVAL = float(os.getenv('CONSUMER_METRICS_INTERVAL', 60))
+
+# Outcomes of IdempotencyStore.claim
+CLAIMED = 'claimed'
+DONE = 'done'
+IN_PROGRESS = 'in_progress'
+
+def retry_queue_name(queue, delay_ms):
+    return f"{queue}.retry.{delay_ms}"
+
+def dead_letter_queue_name(queue):
+    return f"{queue}.dead"
+
+def retry_queue_arguments(queue, delay_ms):
+    return {
+        'x-message-ttl': delay_ms,
+        'x-dead-letter-exchange': '',
+        'x-dead-letter-routing-key': queue
+    }
+
+def declare_retry_topology(channel, queue):
+    """Declare the retry queues and dead-letter queue for `queue` (pika)."""
+    channel.exchange_declare(exchange=DEAD_LETTER_EXCHANGE, exchange_type='direct', durable=True)
+    channel.queue_declare(queue=dead_letter_queue_name(queue), durable=True)
+    channel.queue_bind(queue=dead_letter_queue_name(queue), exchange=DEAD_LETTER_EXCHANGE, routing_key=queue)
+    for delay_ms in RETRY_DELAYS_MS:
+        channel.queue_declare(queue=retry_queue_name(queue, delay_ms), durable=True, arguments=retry_queue_arguments(queue, delay_ms))
+
+async def declare_retry_topology_async(channel, queue):
+    """Declare the retry queues and dead-letter queue for `queue` (aio-pika).
+
+    Returns the dead-letter exchange for use with `fail_async`.
+    """
+    exchange = await channel.declare_exchange(DEAD_LETTER_EXCHANGE, aio_pika.ExchangeType.DIRECT, durable=True)
+    dead = await channel.declare_queue(dead_letter_queue_name(queue), durable=True)
+    await dead.bind(exchange, routing_key=queue)
+    for delay_ms in RETRY_DELAYS_MS:
+        await channel.declare_queue(retry_queue_name(queue, delay_ms), durable=True, arguments=retry_queue_arguments(queue, delay_ms))
+    return exchange
+
+def failure_route(queue, headers, error, permanent=False):
+    """Where a failed delivery goes next.
+
+    Returns (exchange, routing_key, headers, dead_lettered). Deliveries are
+    retried once per RETRY_DELAYS_MS step, then parked on the dead-letter
+    queue; permanent failures (e.g. malformed bodies) skip the retries.
+    """
+    headers = dict(headers or {})
+    attempts = int(headers.get(RETRY_HEADER, 0))
+    headers[RETRY_HEADER] = attempts + 1
+    headers[ERROR_HEADER] = str(error)[:500]
+    if not permanent and attempts < len(RETRY_DELAYS_MS):
+        return '', retry_queue_name(queue, RETRY_DELAYS_MS[attempts]), headers, False
+    return DEAD_LETTER_EXCHANGE, queue, headers, True
+
+def defer_route(queue):
+    """Retry queue for a delivery whose key another attempt still holds.
+
+    It waits out the longest backoff step without using up a retry: either
+    the other attempt finishes (and the delivery is then acked as done) or
+    its claim lapses after a crash and this delivery takes over.
+    """
+    return retry_queue_name(queue, RETRY_DELAYS_MS[-1])
+
+def connect_redis():
+    host = os.getenv('IDEMPOTENCY_REDIS_HOST', os.getenv('REDIS_HOST'))
+    if redis is None or not host:
+        return None
+    return redis.Redis(host=host, port=int(os.getenv('REDIS_PORT', 6379)), db=0, socket_timeout=0.25)
+
+class IdempotencyStore:
+    """Tracks which deliveries have already been handled.
+
+    A key is claimed with a lease while it is being worked on and marked done
+    afterwards. `claim` reports DONE for keys that were completed, which can
+    be acked without doing the work again, and IN_PROGRESS while another
+    attempt holds the lease; those must be deferred, not acked, since the
+    holder may have crashed. A failed attempt releases its claim so the
+    retry can take it. Backed by Redis when REDIS_HOST is set, otherwise by
+    a local TTL cache.
+    """
+
+    PROCESSING = b'processing'
+    DONE = b'done'
+
+    def __init__(self, namespace, redis_client=MISSING, ttl=IDEMPOTENCY_TTL, lease=IDEMPOTENCY_LEASE):
+        self.namespace = namespace
+        self.redis = connect_redis() if redis_client is MISSING else redis_client
+        self.ttl = ttl
+        self.lease = lease
+        self.local = TTLCache(maxsize=int(os.getenv('IDEMPOTENCY_CACHE_SIZE', 65536)), ttl=ttl)
+
+    def _key(self, key):
+        return f"idempotency:{self.namespace}:{key}"
+
+    def claim(self, key):
+        if key is None:
+            return CLAIMED
+        key = self._key(key)
+        if self.redis is not None:
+            try:
+                if self.redis.set(key, self.PROCESSING, nx=True, ex=self.lease):
+                    return CLAIMED
+                return DONE if self.redis.get(key) == self.DONE else IN_PROGRESS
+            except redis.RedisError as e:
+                # Losing deduplication is better than losing the message
+                print(f"Idempotency claim failed, processing anyway: {str(e)}")
+                return CLAIMED
+        state = self.local.get(key)
+        if state is not None:
+            return DONE if state == self.DONE else IN_PROGRESS
+        self.local.set(key, self.PROCESSING, ttl=self.lease)
+        return CLAIMED
+
+    def complete(self, key):
+        if key is None:
+            return
+        key = self._key(key)
+        if self.redis is not None:
+            try:
+                self.redis.set(key, self.DONE, ex=self.ttl)
+            except redis.RedisError as e:
+                print(f"Idempotency completion failed: {str(e)}")
+            return
+        self.local.set(key, self.DONE)
+
+    def release(self, key):
+        if key is None:
+            return
+        key = self._key(key)
+        if self.redis is not None:
+            try:
+                self.redis.delete(key)
+            except redis.RedisError as e:
+                print(f"Idempotency release failed: {str(e)}")
+            return
+        self.local.pop(key)
+
+    # Async consumers share the event loop with every other delivery, so the
+    # blocking Redis round-trips run on the loop's default executor
+    async def _off_loop(self, method, key):
+        if self.redis is None:
+            return method(key)
+        return await asyncio.get_running_loop().run_in_executor(None, method, key)
+
+    async def claim_async(self, key):
+        return await self._off_loop(self.claim, key)
+
+    async def complete_async(self, key):
+        await self._off_loop(self.complete, key)
+
+    async def release_async(self, key):
+        await self._off_loop(self.release, key)
+
+class ConsumerMetrics:
+    """Delivery counters for one queue, logged every METRICS_INTERVAL seconds."""
+
+    def __init__(self, queue, interval=METRICS_INTERVAL):
+        self.queue = queue
+        self.interval = interval
+        self.counts = {'received': 0, 'redelivered': 0, 'acked': 0, 'duplicates': 0, 'deferred': 0, 'retried': 0, 'dead_lettered': 0}
+        self._last_report = time.monotonic()
+
+    def received(self, redelivered, headers):
+        self.counts['received'] += 1
+        # Broker redeliveries (crash before ack) and our own delayed retries
+        if redelivered or int((headers or {}).get(RETRY_HEADER, 0)) > 0:
+            self.counts['redelivered'] += 1
+
+    def record(self, event, count=1):
+        self.counts[event] += count
+        if time.monotonic() - self._last_report >= self.interval:
+            self._last_report = time.monotonic()
+            print(f"Consumer metrics for {self.queue}: {self.snapshot()}")
+
+    def snapshot(self):
+        received = self.counts['received']
+        return dict(self.counts, redelivery_rate=self.counts['redelivered'] / received if received else 0.0)
+
+class ReliableConsumer:
+    """Manual-ack consumption helpers for a pika BlockingChannel.
+
+    Declares the queue's retry and dead-letter topology up front. Callers ack
+    with `ack` once the work is durable, and hand failures to `fail`, which
+    republishes the message to the next retry queue (or the dead-letter
+    queue) before acking the original. Deliveries whose key is still held by
+    another attempt go to `defer`. `retry` and `postpone` are the publish
+    halves of `fail` and `defer`, for callers that ack in bulk.
+    """
+
+    def __init__(self, channel, queue, idempotency=True):
+        self.channel = channel
+        self.queue = queue
+        self.metrics = ConsumerMetrics(queue)
+        self.idempotency = IdempotencyStore(queue) if idempotency else None
+        declare_retry_topology(channel, queue)
+
+    def received(self, method, properties):
+        self.metrics.received(method.redelivered, properties.headers)
+
+    def claim(self, key):
+        """CLAIMED, DONE (ack without processing) or IN_PROGRESS (defer)."""
+        state = CLAIMED if self.idempotency is None else self.idempotency.claim(key)
+        if state == DONE:
+            self.metrics.record('duplicates')
+        return state
+
+    def complete(self, key):
+        if self.idempotency is not None:
+            self.idempotency.complete(key)
+
+    def release(self, key):
+        if self.idempotency is not None:
+            self.idempotency.release(key)
+
+    def ack(self, delivery_tag, multiple=False, count=1):
+        self.channel.basic_ack(delivery_tag=delivery_tag, multiple=multiple)
+        self.metrics.record('acked', count)
+
+    def _republish(self, exchange, routing_key, properties, body, headers):
+        self.channel.basic_publish(
+            exchange=exchange,
+            routing_key=routing_key,
+            body=body,
+            properties=pika.BasicProperties(
+                headers=headers,
+                priority=properties.priority,
+                message_id=properties.message_id,
+                content_type=properties.content_type,
+                delivery_mode=2
+            )
+        )
+
+    def retry(self, properties, body, error, permanent=False):
+        exchange, routing_key, headers, dead_lettered = failure_route(self.queue, properties.headers, error, permanent)
+        self._republish(exchange, routing_key, properties, body, headers)
+        self.metrics.record('dead_lettered' if dead_lettered else 'retried')
+        if dead_lettered:
+            print(f"Dead-lettered message from {self.queue}: {str(error)}")
+
+    def fail(self, method, properties, body, error, permanent=False):
+        self.retry(properties, body, error, permanent)
+        self.ack(method.delivery_tag)
+
+    def postpone(self, properties, body):
+        self._republish('', defer_route(self.queue), properties, body, properties.headers)
+        self.metrics.record('deferred')
+
+    def defer(self, method, properties, body):
+        self.postpone(properties, body)
+        self.ack(method.delivery_tag)
+
+async def fail_async(channel, dead_letter_exchange, queue, message, error, metrics, permanent=False):
+    """aio-pika counterpart of ReliableConsumer.fail."""
+    exchange, routing_key, headers, dead_lettered = failure_route(queue, message.headers, error, permanent)
+    target = dead_letter_exchange if exchange else channel.default_exchange
+    await target.publish(
+        aio_pika.Message(
+            body=message.body,
+            headers=headers,
+            priority=message.priority,
+            message_id=message.message_id,
+            content_type=message.content_type,
+            delivery_mode=aio_pika.DeliveryMode.PERSISTENT
+        ),
+        routing_key=routing_key
+    )
+    await message.ack()
+    metrics.record('dead_lettered' if dead_lettered else 'retried')
+    if dead_lettered:
+        print(f"Dead-lettered message from {queue}: {str(error)}")
+
+async def defer_async(channel, queue, message, metrics):
+    """aio-pika counterpart of ReliableConsumer.defer."""
+    await channel.default_exchange.publish(
+        aio_pika.Message(
+            body=message.body,
+            headers=message.headers,
+            priority=message.priority,
+            message_id=message.message_id,
+            content_type=message.content_type,
+            delivery_mode=aio_pika.DeliveryMode.PERSISTENT
+        ),
+        routing_key=defer_route(queue)
+    )
+    await message.ack()
+    metrics.record('deferred')
@@ -3,58 +3,213 @@
 import pika
 import os
 import json
-import requests
+import time
+import redis
+from advisors import ADVISORS
+from hasura_client import HasuraClient
+from reliable_consumer import ReliableConsumer, DONE, IN_PROGRESS
+
+RESPONSE_BATCH_SIZE = int(os.getenv('RESPONSE_BATCH_SIZE', 50))
+RESPONSE_FLUSH_MS = int(os.getenv('RESPONSE_FLUSH_MS', 200))
+TASK_RESULT_DEADLINE = float(os.getenv('TASK_RESULT_DEADLINE', 60))
+TASK_RESULT_TTL = int(os.getenv('TASK_RESULT_TTL', 86400))
+
+hasura = HasuraClient()
+redis_client = redis.Redis(host=os.getenv('REDIS_HOST', 'localhost'), port=6379, db=0)
+
+# Per-task assembly state lives in Redis so it survives restarts and is
+# shared by every aggregator: task_state:<task_id> is a hash of user_id,
+# expected advisors, deadline and one result:<service> field per answer, and
+# task_state:pending scores unfinished task ids by their deadline.
+PENDING_KEY = 'task_state:pending'
+
+def state_key(task_id):
+    return f"task_state:{task_id}"
 
 def connect_rabbitmq():
     credentials = pika.PlainCredentials(os.getenv('RABBITMQ_USER'), os.getenv('RABBITMQ_PASS'))
     connection = pika.BlockingConnection(pika.ConnectionParameters(host=os.getenv('RABBITMQ_HOST'), credentials=credentials))
     return connection
 
-def store_response(response_data):
-    hasura_endpoint = os.getenv('HASURA_GRAPHQL_ENDPOINT')
-    hasura_admin_secret = os.getenv('HASURA_ADMIN_SECRET')
-    
-    headers = {
-        'Content-Type': 'application/json',
-        'X-Hasura-Admin-Secret': hasura_admin_secret
-    }
-    
-    query = """
-    mutation ($user_id: String!, $task_id: String!, $service: String!, $content: jsonb!) {
-      insert_responses_one(object: {user_id: $user_id, task_id: $task_id, service: $service, content: $content}) {
-        id
-      }
-    }
-    """
-    
+def store_responses(responses):
     variables = {
-        "user_id": response_data['user_id'],
-        "task_id": response_data['task_id'],
-        "service": response_data['service'],
-        "content": json.dumps(response_data['content'])
+        "objects": [
+            {
+                "user_id": response_data['user_id'],
+                "task_id": response_data['task_id'],
+                "service": response_data['service'],
+                "content": json.dumps(response_data['content'])
+            }
+            for response_data in responses
+        ]
     }
     
-    response = requests.post(hasura_endpoint, json={'query': query, 'variables': variables}, headers=headers)
-    response.raise_for_status()
-    return response.json()
+    result = hasura.execute_operation('InsertResponses', variables)
+    if result.get('errors'):
+        raise Exception(result['errors'])
+    return result
+
+def store_task_result(task_result):
+    variables = {'result': dict(task_result, results=json.dumps(task_result['results']))}
+
+    result = hasura.execute_operation('UpsertTaskResult', variables)
+    if result.get('errors'):
+        raise Exception(result['errors'])
+
+    # The gateway serves results from Redis and long-polls on the channel
+    key = f"task_result:{task_result['task_id']}"
+    body = json.dumps(task_result)
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.set(key, body, ex=TASK_RESULT_TTL)
+    pipe.publish(key, body)
+    pipe.execute()
+
+def track_responses(responses):
+    """Merge responses into their tasks' state; returns the task ids touched."""
+    deadline = time.time() + TASK_RESULT_DEADLINE
+    pipe = redis_client.pipeline(transaction=False)
+    for response_data in responses:
+        key = state_key(response_data['task_id'])
+        pipe.hsetnx(key, 'user_id', response_data['user_id'])
+        pipe.hsetnx(key, 'expected', json.dumps(response_data.get('advisors') or list(ADVISORS)))
+        pipe.hsetnx(key, 'deadline', deadline)
+        pipe.hset(key, f"result:{response_data['service']}", json.dumps(response_data['content']))
+        pipe.expire(key, TASK_RESULT_TTL)
+        pipe.zadd(PENDING_KEY, {response_data['task_id']: deadline}, nx=True)
+    pipe.execute()
+    return {response_data['task_id'] for response_data in responses}
+
+def load_state(task_id):
+    state = redis_client.hgetall(state_key(task_id))
+    if not state:
+        return None
+    state = {field.decode('utf-8'): value for field, value in state.items()}
+    return {
+        'user_id': state['user_id'].decode('utf-8'),
+        'expected': set(json.loads(state['expected'])),
+        'deadline': float(state['deadline']),
+        'results': {
+            field[len('result:'):]: json.loads(value)
+            for field, value in state.items() if field.startswith('result:')
+        }
+    }
+
+def assemble_results(touched=()):
+    # A task is written once every expected advisor has answered or its
+    # deadline passes. Its state outlives a partial write, so a late answer
+    # is merged with the earlier ones and the row rewritten, never replaced
+    # by the late answer alone.
+    now = time.time()
+    due = {task_id.decode('utf-8') for task_id in redis_client.zrangebyscore(PENDING_KEY, '-inf', now)}
+    for task_id in due | set(touched):
+        state = load_state(task_id)
+        if state is None:
+            redis_client.zrem(PENDING_KEY, task_id)
+            continue
+        complete = state['expected'] <= set(state['results'])
+        if not (complete or now >= state['deadline']):
+            continue
+        task_result = {
+            'task_id': task_id,
+            'user_id': state['user_id'],
+            'status': 'completed' if complete else 'partial',
+            'results': state['results']
+        }
+        try:
+            store_task_result(task_result)
+            redis_client.zrem(PENDING_KEY, task_id)
+            print(f"Assembled {task_result['status']} result for task: {task_id}")
+        except Exception as e:
+            print(f"Error assembling result for task {task_id}: {str(e)}")
+
+def response_key(response_data):
+    key = f"{response_data['task_id']}:{response_data['service']}"
+    return f"{key}:{response_data['run_id']}" if response_data.get('run_id') else key
 
 def main():
     connection = connect_rabbitmq()
     channel = connection.channel()
-    channel.queue_declare(queue='response_queue')
+    channel.queue_declare(queue='response_queue', durable=True)
+    # Keep enough unacked messages in hand to fill a batch while the previous one flushes
+    channel.basic_qos(prefetch_count=RESPONSE_BATCH_SIZE * 2)
+    consumer = ReliableConsumer(channel, 'response_queue')
+
+    flush_interval = RESPONSE_FLUSH_MS / 1000.0
+    # (response_data, properties, body) for each buffered delivery
+    buffer = []
+    last_delivery_tag = None
+    unacked = 0
+    flush_deadline = None
+    # Tasks that got answers since the last assembly pass
+    touched = set()
 
-    def callback(ch, method, properties, body):
-        response_data = json.loads(body)
-        print(f"Aggregating response from {response_data['service']}")
+    def flush():
+        responses = [response_data for response_data, _, _ in buffer]
         try:
-            result = store_response(response_data)
-            print(f"Stored response with ID: {result['data']['insert_responses_one']['id']}")
+            # Merging into task state is idempotent, so it goes first: a
+            # batch that fails either way is retried as a whole
+            task_ids = track_responses(responses)
+            result = store_responses(responses)
+            print(f"Stored {result['data']['insert_responses']['affected_rows']} responses")
+            for response_data in responses:
+                consumer.complete(response_key(response_data))
+            touched.update(task_ids)
         except Exception as e:
-            print(f"Error storing response: {str(e)}")
+            print(f"Error storing responses: {str(e)}")
+            # Each response retries on its own backoff schedule rather than
+            # the whole batch being requeued straight back at us
+            for response_data, properties, body in buffer:
+                consumer.release(response_key(response_data))
+                consumer.retry(properties, body, e)
+        # Everything up to the last delivery is now durable in Hasura or
+        # parked on a retry queue
+        consumer.ack(last_delivery_tag, multiple=True, count=unacked)
 
-    channel.basic_consume(queue='response_queue', on_message_callback=callback, auto_ack=True)
     print('Response Aggregator Service waiting for messages...')
-    channel.start_consuming()
+    for method, properties, body in channel.consume('response_queue', inactivity_timeout=flush_interval):
+        if method is not None:
+            consumer.received(method, properties)
+            try:
+                response_data = json.loads(body)
+                key = response_key(response_data)
+            except (ValueError, KeyError) as e:
+                print('Dead-lettering malformed response message')
+                consumer.retry(properties, body, e, permanent=True)
+                key = None
+                response_data = None
+            if response_data is not None:
+                state = consumer.claim(key)
+                if state == DONE:
+                    print(f"Skipping duplicate response {key}")
+                    response_data = None
+                elif state == IN_PROGRESS:
+                    # Another attempt holds the key, possibly one that crashed;
+                    # acked with the rest of the batch once it is republished
+                    consumer.postpone(properties, body)
+                    response_data = None
+            if not buffer and not unacked:
+                flush_deadline = time.monotonic() + flush_interval
+            if response_data is not None:
+                print(f"Aggregating response from {response_data['service']}")
+                buffer.append((response_data, properties, body))
+            last_delivery_tag = method.delivery_tag
+            unacked += 1
+
+        if unacked and (len(buffer) >= RESPONSE_BATCH_SIZE or time.monotonic() >= flush_deadline):
+            if buffer:
+                flush()
+            else:
+                consumer.ack(last_delivery_tag, multiple=True, count=unacked)
+            buffer = []
+            unacked = 0
+
+        try:
+            assemble_results(touched)
+            touched.clear()
+        except Exception as e:
+            # Task state stays in Redis; the touched tasks are retried on the
+            # next pass
+            print(f"Error assembling results: {str(e)}")
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,153 @@
+# smtp_pool.py
+
+import os
+import queue
+import smtplib
+import time
+from contextlib import contextmanager
+
+# Errors after which a pooled session can no longer be trusted
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, smtplib.SMTPHeloError, OSError)
+
+class SMTPSession:
+    def __init__(self, server):
+        self.server = server
+        self.sent = 0
+        self.last_used = time.monotonic()
+
+class SMTPPool:
+    """Thread-safe pool of authenticated SMTP sessions.
+
+    Sessions are opened lazily (connect, STARTTLS, login once) and reused
+    across messages. A session is retired after `max_messages` sends, since
+    most providers cap messages per connection, or after sitting idle for
+    `max_idle` seconds, and replaced when the server drops it.
+    """
+
+    def __init__(self, host=None, port=None, username=None, password=None, size=None, max_messages=None,
+                 max_idle=None, timeout=None, checkout_timeout=None):
+        self.host = host or os.getenv('SMTP_SERVER')
+        self.port = int(port or os.getenv('SMTP_PORT', 587))
+        self.username = username or os.getenv('SMTP_USERNAME')
+        self.password = password or os.getenv('SMTP_PASSWORD')
+        self.size = size or int(os.getenv('SMTP_POOL_SIZE', 2))
+        self.max_messages = max_messages or int(os.getenv('SMTP_MAX_MESSAGES_PER_CONNECTION', 100))
+        self.max_idle = max_idle or float(os.getenv('SMTP_MAX_IDLE', 60))
+        self.timeout = timeout or float(os.getenv('SMTP_TIMEOUT', 30))
+        self.checkout_timeout = checkout_timeout or float(os.getenv('SMTP_POOL_TIMEOUT', 30))
+        self._slots = queue.LifoQueue(maxsize=self.size)
+        for _ in range(self.size):
+            self._slots.put(None)
+        self.counts = {'connections': 0, 'sent': 0, 'failed': 0, 'reconnects': 0}
+
+    def _open(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            server.starttls()
+            if self.username:
+                server.login(self.username, self.password)
+        except Exception:
+            server.close()
+            raise
+        self.counts['connections'] += 1
+        return SMTPSession(server)
+
+    def _close(self, session):
+        if session is None:
+            return
+        try:
+            session.server.quit()
+        except Exception:
+            try:
+                session.server.close()
+            except Exception:
+                pass
+
+    def _usable(self, session):
+        return (
+            session is not None
+            and session.sent < self.max_messages
+            and time.monotonic() - session.last_used < self.max_idle
+        )
+
+    @contextmanager
+    def session(self):
+        try:
+            session = self._slots.get(timeout=self.checkout_timeout)
+        except queue.Empty:
+            raise smtplib.SMTPConnectError(-1, 'Timed out waiting for a pooled SMTP connection')
+        try:
+            if not self._usable(session):
+                self._close(session)
+                session = None
+                session = self._open()
+            yield session
+        except CONNECTION_ERRORS:
+            self._close(session)
+            session = None
+            raise
+        finally:
+            self._slots.put(session)
+
+    def _send(self, session, msg):
+        session.server.send_message(msg)
+        session.sent += 1
+        session.last_used = time.monotonic()
+        self.counts['sent'] += 1
+
+    def send_many(self, messages):
+        """Send a batch over as few sessions as possible.
+
+        Returns one entry per message: None when it was sent, otherwise the
+        exception. A dropped or exhausted session is replaced mid-batch; a
+        message the server rejects outright does not stop the rest. Any other
+        SMTP error, such as failed authentication, fails the messages not yet
+        sent instead of escaping to the caller.
+        """
+        results = [None] * len(messages)
+        index = 0
+        reconnected = False
+        while index < len(messages):
+            try:
+                with self.session() as session:
+                    while index < len(messages) and session.sent < self.max_messages:
+                        try:
+                            self._send(session, messages[index])
+                        except smtplib.SMTPRecipientsRefused as e:
+                            results[index] = e
+                            self.counts['failed'] += 1
+                        except smtplib.SMTPResponseException as e:
+                            if e.smtp_code == 421:
+                                raise smtplib.SMTPServerDisconnected(str(e))
+                            results[index] = e
+                            self.counts['failed'] += 1
+                        index += 1
+                        reconnected = False
+            except CONNECTION_ERRORS as e:
+                if reconnected:
+                    # A fresh session failed too; fail the message and move on
+                    results[index] = e
+                    self.counts['failed'] += 1
+                    index += 1
+                    reconnected = False
+                    continue
+                self.counts['reconnects'] += 1
+                reconnected = True
+                print(f"SMTP session dropped mid-batch, reconnecting: {str(e)}")
+            except smtplib.SMTPException as e:
+                print(f"SMTP session failed, failing {len(messages) - index} messages: {str(e)}")
+                for i in range(index, len(messages)):
+                    results[i] = e
+                self.counts['failed'] += len(messages) - index
+                break
+        return results
+
+    def stats(self):
+        return dict(self.counts, size=self.size, max_messages=self.max_messages)
+
+    def close(self):
+        while True:
+            try:
+                self._close(self._slots.get_nowait())
+            except queue.Empty:
+                break
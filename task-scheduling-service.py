@@ -1,91 +1,104 @@
 # Microservices/TaskSchedulingService.py
 
 from flask import Flask, request, jsonify
-import requests
 import os
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
-from apscheduler.executors.pool import ThreadPoolExecutor
-import jwt
-from functools import wraps
+import json
+import pika
+from auth import token_required
+from hasura_client import HasuraClient
+from rabbitmq_pool import PublisherPool
+from job_scheduler import RedisScheduler
+from advisors import ADVISORS, TASK_EXCHANGE, PRIORITY_BACKGROUND, routing_key_for, declare_advisor_queue
 
 app = Flask(__name__)
 
-# Configure APScheduler
-jobstores = {
-    'default': SQLAlchemyJobStore(url='sqlite:///jobs.sqlite')
-}
-executors = {
-    'default': ThreadPoolExecutor(20)
-}
-job_defaults = {
-    'coalesce': False,
-    'max_instances': 3
-}
-scheduler = BackgroundScheduler(jobstores=jobstores, executors=executors, job_defaults=job_defaults)
-scheduler.start()
-
-def token_required(f):
-    @wraps(f)
-    def decorated(*args, **kwargs):
-        token = request.headers.get('Authorization')
-        if not token:
-            return jsonify({'message': 'Token is missing!'}), 401
-        try:
-            data = jwt.decode(token, os.getenv('JWT_SECRET'), algorithms=["HS256"])
-        except:
-            return jsonify({'message': 'Token is invalid!'}), 401
-        return f(data['user_id'], *args, **kwargs)
-    return decorated
-
-def get_hasura_client():
-    hasura_endpoint = os.getenv('HASURA_GRAPHQL_ENDPOINT')
-    hasura_admin_secret = os.getenv('HASURA_ADMIN_SECRET')
-    
-    headers = {
-        'Content-Type': 'application/json',
-        'X-Hasura-Admin-Secret': hasura_admin_secret
-    }
-    return hasura_endpoint, headers
-
-def trigger_task(task_id):
-    # This function will be called by the scheduler when it's time to execute a task
-    hasura_endpoint, headers = get_hasura_client()
-    
-    query = """
-    query ($task_id: uuid!) {
-      tasks_by_pk(id: $task_id) {
-        id
-        user_id
-        content
-      }
+MAX_SCHEDULE_BATCH = int(os.getenv('MAX_SCHEDULE_BATCH', 1000))
+
+hasura = HasuraClient()
+
+def declare_advisor_topology(channel):
+    for service in ADVISORS:
+        declare_advisor_queue(channel, service)
+
+publisher = PublisherPool(queues=['notification_queue'], topology=declare_advisor_topology)
+
+def fetch_tasks(task_ids):
+    # {task_id: task} for every id Hasura can resolve. If the query itself is
+    # rejected (e.g. a malformed id) each id is looked up alone so a bad one
+    # only drops itself; transport errors still raise so the batch is retried.
+    result = hasura.execute_operation('TasksByIds', {'task_ids': task_ids})
+    if not result.get('errors'):
+        return {task['id']: task for task in result['data']['tasks']}
+    if len(task_ids) == 1:
+        print(f"Could not resolve scheduled task {task_ids[0]}: {result['errors']}")
+        return {}
+    tasks = {}
+    for task_id in task_ids:
+        tasks.update(fetch_tasks([task_id]))
+    return tasks
+
+def reminder(task):
+    return {
+        'user_id': task['user_id'],
+        'subject': 'Task Reminder',
+        'body': f"Don't forget to work on your task: {task['content']}"
     }
-    """
-    variables = {'task_id': task_id}
-    response = requests.post(hasura_endpoint, json={'query': query, 'variables': variables}, headers=headers)
-    task = response.json()['data']['tasks_by_pk']
-    
-    if task:
-        # Trigger the task processing pipeline
-        # This could involve sending messages to RabbitMQ queues, as in our previous setup
-        print(f"Triggering task: {task['id']} for user: {task['user_id']}")
-        # Add your task triggering logic here
+
+def run_due_jobs(jobs):
+    # Called by the scheduler with every job due in the current window: one
+    # Hasura query for all of their tasks, then one bulk publish of the
+    # advisor replays and reminder emails. Jobs whose task cannot be resolved
+    # are returned so the scheduler deletes them; if anything else fails the
+    # batch is claimed again once its lease expires. Run ids are derived from
+    # the fire time, so consumers drop the parts that already went out.
+    tasks = fetch_tasks(list({job['task_id'] for job in jobs}))
+    messages = []
+    dropped = []
+    for job in jobs:
+        task = tasks.get(job['task_id'])
+        if task is None:
+            print(f"Scheduled task not found, dropping job: {job['task_id']}")
+            dropped.append(job['id'])
+            continue
+        if job.get('user_id') != task['user_id']:
+            # Only a task's owner may schedule it; anyone else's job would
+            # mail the owner and spend LLM budget on their content
+            print(f"Scheduled task {job['task_id']} belongs to another user, dropping job")
+            dropped.append(job['id'])
+            continue
+        run_id = f"{job['id']}:{int(job['run_at'])}"
+        # Replays go through the same advisor pipeline as /task, but at
+        # background priority so interactive requests are served first
+        replay = {
+            'user_id': task['user_id'],
+            'task_id': task['id'],
+            'content': task['content'],
+            'advisors': list(ADVISORS),
+            'run_id': run_id
+        }
+        messages.append((TASK_EXCHANGE, routing_key_for(), json.dumps(replay), pika.BasicProperties(priority=PRIORITY_BACKGROUND, delivery_mode=2)))
+        messages.append(('', 'notification_queue', json.dumps(reminder(task)), pika.BasicProperties(message_id=f"{run_id}:reminder", delivery_mode=2)))
+    publisher.publish_many(messages)
+    print(f"Dispatched {len(messages) // 2} of {len(jobs)} scheduled tasks")
+    return dropped
+
+# Jobs live in Redis and are claimed under a lease, so every replica can run
+# the dispatcher and each job still fires once
+scheduler = RedisScheduler(run_due_jobs)
+scheduler.start()
 
 @app.route('/schedule', methods=['POST'])
 @token_required
 def schedule_task(user_id):
     data = request.json
-    if not data or not data.get('task_id') or not data.get('schedule_time'):
+    if not data or not data.get('task_id') or not (data.get('schedule_time') or data.get('trigger')):
         return jsonify({'message': 'Invalid input'}), 400
 
-    # Schedule the task
-    scheduler.add_job(
-        trigger_task, 
-        'date', 
-        run_date=data['schedule_time'], 
-        args=[data['task_id']], 
-        id=data['task_id']
-    )
+    result = scheduler.apply_requests([dict(data, op='schedule')], user_id)[0]
+    if result['status'] == 'invalid':
+        return jsonify({'message': 'Invalid schedule', 'error': result['error']}), 400
+    if result['status'] == 'conflict':
+        return jsonify({'message': 'Task is already scheduled'}), 409
 
     return jsonify({'message': 'Task scheduled successfully'}), 200
 
@@ -93,15 +106,14 @@ def schedule_task(user_id):
 @token_required
 def reschedule_task(user_id):
     data = request.json
-    if not data or not data.get('task_id') or not data.get('new_schedule_time'):
+    if not data or not data.get('task_id') or not (data.get('new_schedule_time') or data.get('trigger')):
         return jsonify({'message': 'Invalid input'}), 400
 
-    # Reschedule the task
-    scheduler.reschedule_job(
-        data['task_id'], 
-        trigger='date', 
-        run_date=data['new_schedule_time']
-    )
+    result = scheduler.apply_requests([dict(data, op='reschedule')], user_id)[0]
+    if result['status'] == 'invalid':
+        return jsonify({'message': 'Invalid schedule', 'error': result['error']}), 400
+    if result['status'] == 'not_found':
+        return jsonify({'message': 'Scheduled task not found'}), 404
 
     return jsonify({'message': 'Task rescheduled successfully'}), 200
 
@@ -112,10 +124,24 @@ def cancel_task(user_id):
     if not data or not data.get('task_id'):
         return jsonify({'message': 'Invalid input'}), 400
 
-    # Cancel the scheduled task
-    scheduler.remove_job(data['task_id'])
+    if not scheduler.remove(data['task_id'], owner=user_id):
+        return jsonify({'message': 'Scheduled task not found'}), 404
 
     return jsonify({'message': 'Task cancelled successfully'}), 200
 
+@app.route('/schedule/batch', methods=['POST'])
+@token_required
+def schedule_batch(user_id):
+    # {"operations": [{"op": "schedule" | "reschedule" | "cancel", "task_id": ..., ...}]},
+    # applied in one job-store transaction with a status per operation
+    data = request.json
+    operations = data.get('operations') if data else None
+    if not isinstance(operations, list) or not operations:
+        return jsonify({'message': 'Invalid input'}), 400
+    if len(operations) > MAX_SCHEDULE_BATCH:
+        return jsonify({'message': f"At most {MAX_SCHEDULE_BATCH} operations per batch"}), 400
+
+    return jsonify({'results': scheduler.apply_requests(operations, user_id)}), 200
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5001)
@@ -0,0 +1,85 @@
+# token_budget.py
+
+import asyncio
+import os
+import time
+
+def estimate_tokens(text):
+    # Roughly four characters per token for English text across providers
+    return len(text or '') // 4 + 1
+
+class RateBucket:
+    """Continuously refilled per-minute allowance."""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.available = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        self._refill()
+        # A request larger than the whole bucket is admitted once it is full
+        amount = min(amount, self.capacity)
+        if self.available >= amount:
+            return 0.0
+        return (amount - self.available) / self.rate
+
+    def take(self, amount):
+        self.available -= min(amount, self.capacity)
+
+class TokenBudget:
+    """Admits provider calls against per-provider token-per-minute and
+    request-per-minute quotas, configured as LLM_TPM_<PROVIDER> and
+    LLM_RPM_<PROVIDER>. Providers without a configured quota are unlimited.
+    Budgets are per process, so set them to each replica's share.
+    """
+
+    def __init__(self):
+        self.tokens = {}
+        self.requests = {}
+        self.waited = {}
+        self._locks = {}
+
+    def _bucket(self, buckets, kind, provider):
+        if provider not in buckets:
+            limit = os.getenv(f"LLM_{kind}_{provider.upper()}")
+            buckets[provider] = RateBucket(int(limit)) if limit else None
+        return buckets[provider]
+
+    def wait_time(self, provider, tokens):
+        token_bucket = self._bucket(self.tokens, 'TPM', provider)
+        request_bucket = self._bucket(self.requests, 'RPM', provider)
+        return max(
+            token_bucket.wait_time(tokens) if token_bucket else 0.0,
+            request_bucket.wait_time(1) if request_bucket else 0.0
+        )
+
+    async def admit(self, provider, prompt, max_tokens=None):
+        tokens = estimate_tokens(prompt) + (max_tokens or 300)
+        # Admission is serialized per provider so waiting callers are served in order
+        async with self._locks.setdefault(provider, asyncio.Lock()):
+            while True:
+                delay = self.wait_time(provider, tokens)
+                if delay <= 0:
+                    break
+                self.waited[provider] = self.waited.get(provider, 0.0) + delay
+                await asyncio.sleep(delay)
+            if self.tokens[provider]:
+                self.tokens[provider].take(tokens)
+            if self.requests[provider]:
+                self.requests[provider].take(1)
+
+    def stats(self):
+        return {
+            provider: {
+                'tokens_available': bucket.available if bucket else None,
+                'seconds_waited': self.waited.get(provider, 0.0)
+            }
+            for provider, bucket in self.tokens.items()
+        }
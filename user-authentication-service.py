@@ -4,21 +4,23 @@ from flask import Flask, request, jsonify
 import jwt
 import datetime
 import os
-from werkzeug.security import generate_password_hash, check_password_hash
 import uuid
-import requests
+from hasura_client import HasuraClient
+from rabbitmq_pool import PublisherPool
+import user_email_cache
+from password_hashing import PasswordHasher, HashQueueFull
 
 app = Flask(__name__)
 
-def get_hasura_client():
-    hasura_endpoint = os.getenv('HASURA_GRAPHQL_ENDPOINT')
-    hasura_admin_secret = os.getenv('HASURA_ADMIN_SECRET')
-    
-    headers = {
-        'Content-Type': 'application/json',
-        'X-Hasura-Admin-Secret': hasura_admin_secret
-    }
-    return hasura_endpoint, headers
+hasura = HasuraClient()
+publisher = PublisherPool(topology=user_email_cache.declare_user_events)
+hasher = PasswordHasher()
+
+def issue_token(user_id):
+    return jwt.encode({
+        'user_id': user_id,
+        'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=24)
+    }, os.getenv('JWT_SECRET'))
 
 @app.route('/register', methods=['POST'])
 def register():
@@ -26,73 +28,73 @@ def register():
     if not data or not data.get('email') or not data.get('password'):
         return jsonify({'message': 'Invalid input'}), 400
 
-    hasura_endpoint, headers = get_hasura_client()
-    
-    # Check if user already exists
-    query = """
-    query ($email: String!) {
-      users(where: {email: {_eq: $email}}) {
-        id
-      }
-    }
-    """
-    variables = {'email': data['email']}
-    response = requests.post(hasura_endpoint, json={'query': query, 'variables': variables}, headers=headers)
-    
-    if response.json()['data']['users']:
-        return jsonify({'message': 'User already exists'}), 400
-
-    # Create new user
-    hashed_password = generate_password_hash(data['password'], method='sha256')
+    # The hash comes before the insert, so even a duplicate email costs one;
+    # HashQueueFull bounds how many of those can pile up at once
+    try:
+        hashed_password = hasher.hash(data['password'])
+    except HashQueueFull:
+        return jsonify({'message': 'Server busy, try again later'}), 503, {'Retry-After': '1'}
     user_id = str(uuid.uuid4())
-    
-    mutation = """
-    mutation ($id: uuid!, $email: String!, $password: String!) {
-      insert_users_one(object: {id: $id, email: $email, password: $password}) {
-        id
-      }
-    }
-    """
+
+    # One round trip: the unique email constraint decides whether the user
+    # already exists, and on_conflict turns that into a null result rather
+    # than an error
     variables = {'id': user_id, 'email': data['email'], 'password': hashed_password}
-    response = requests.post(hasura_endpoint, json={'query': mutation, 'variables': variables}, headers=headers)
-    
-    if response.status_code == 200 and not response.json().get('errors'):
-        return jsonify({'message': 'User created successfully'}), 201
-    else:
+    try:
+        result = hasura.execute_operation('InsertUser', variables)
+    except Exception as e:
+        print(f"Error creating user: {str(e)}")
         return jsonify({'message': 'Error creating user'}), 500
 
+    if result.get('errors'):
+        return jsonify({'message': 'Error creating user'}), 500
+    if result['data']['insert_users_one'] is None:
+        return jsonify({'message': 'User already exists'}), 400
+
+    try:
+        # Other services may have cached this user as not found
+        user_email_cache.publish_user_changed(publisher, user_id)
+    except Exception as e:
+        print(f"Error publishing user change: {str(e)}")
+    return jsonify({'message': 'User created successfully', 'user_id': user_id, 'token': issue_token(user_id)}), 201
+
+def rehash_password(user_id, password):
+    # Upgrade hashes from an older scheme or cost while we have the
+    # plaintext. Runs after the response, on spare hashing capacity; a
+    # skipped or failed upgrade only means we try again next login.
+    def save(hashed_password):
+        result = hasura.execute_operation('UpdateUserPassword', {'id': user_id, 'password': hashed_password})
+        if result.get('errors'):
+            raise Exception(result['errors'])
+
+    hasher.rehash(password, save)
+
 @app.route('/login', methods=['POST'])
 def login():
     auth = request.json
     if not auth or not auth.get('email') or not auth.get('password'):
         return jsonify({'message': 'Could not verify'}), 401
 
-    hasura_endpoint, headers = get_hasura_client()
-    
-    query = """
-    query ($email: String!) {
-      users(where: {email: {_eq: $email}}) {
-        id
-        password
-      }
-    }
-    """
     variables = {'email': auth['email']}
-    response = requests.post(hasura_endpoint, json={'query': query, 'variables': variables}, headers=headers)
-    
-    user = response.json()['data']['users']
+    user = hasura.execute_operation('UserCredentials', variables)['data']['users']
     if not user:
         return jsonify({'message': 'User not found'}), 401
     
-    if check_password_hash(user[0]['password'], auth['password']):
-        token = jwt.encode({
-            'user_id': user[0]['id'],
-            'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=24)
-        }, os.getenv('JWT_SECRET'))
-        
-        return jsonify({'token': token})
+    try:
+        valid = hasher.verify(user[0]['password'], auth['password'])
+    except HashQueueFull:
+        return jsonify({'message': 'Server busy, try again later'}), 503, {'Retry-After': '1'}
+
+    if valid:
+        if hasher.needs_rehash(user[0]['password']):
+            rehash_password(user[0]['id'], auth['password'])
+        return jsonify({'token': issue_token(user[0]['id'])})
     
     return jsonify({'message': 'Invalid credentials'}), 401
 
+@app.route('/health')
+def health():
+    return jsonify({"status": "healthy", "password_hashing": hasher.stats(), "hasura": hasura.metrics()}), 200
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)
@@ -0,0 +1,105 @@
+# user_email_cache.py
+
+import json
+import os
+import threading
+import time
+import pika
+from ttl_cache import TTLCache, MISSING
+from rabbitmq_pool import connection_parameters
+
+USER_EVENTS_EXCHANGE = 'user_events'
+NEGATIVE_TTL = int(os.getenv('USER_EMAIL_NEGATIVE_TTL', 30))
+
+# user_id -> email, or None for users that were not found
+cache = TTLCache(
+    maxsize=int(os.getenv('USER_EMAIL_CACHE_SIZE', 10000)),
+    ttl=int(os.getenv('USER_EMAIL_CACHE_TTL', 600))
+)
+
+def _fetch(hasura, operation, variables):
+    result = hasura.execute_operation(operation, variables)
+    if result.get('errors'):
+        raise Exception(result['errors'])
+    return result['data']
+
+def _remember(user_id, email):
+    # Unknown users are only remembered briefly, in case they are about to register
+    cache.set(user_id, email, ttl=None if email else NEGATIVE_TTL)
+
+def lookup(hasura, user_id):
+    email = cache.get(user_id, MISSING)
+    if email is MISSING:
+        user = _fetch(hasura, 'UserEmail', {'user_id': user_id})['users_by_pk']
+        email = user['email'] if user else None
+        _remember(user_id, email)
+    return email
+
+def lookup_many(hasura, user_ids):
+    """Resolve many user_ids to emails with at most one Hasura query.
+
+    Returns {user_id: email or None}.
+    """
+    emails = {}
+    misses = []
+    for user_id in dict.fromkeys(user_ids):
+        email = cache.get(user_id, MISSING)
+        if email is MISSING:
+            misses.append(user_id)
+        else:
+            emails[user_id] = email
+    if misses:
+        users = _fetch(hasura, 'UserEmails', {'user_ids': misses})['users']
+        found = {user['id']: user['email'] for user in users}
+        for user_id in misses:
+            emails[user_id] = found.get(user_id)
+            _remember(user_id, emails[user_id])
+    return emails
+
+def invalidate(user_id):
+    cache.pop(user_id)
+
+def declare_user_events(channel):
+    channel.exchange_declare(exchange=USER_EVENTS_EXCHANGE, exchange_type='fanout', durable=True)
+
+def publish_user_changed(publisher, user_id):
+    # The publisher's topology must include declare_user_events
+    invalidate(user_id)
+    publisher.publish(USER_EVENTS_EXCHANGE, '', json.dumps({'type': 'user_changed', 'user_id': user_id}))
+
+def listen_for_invalidations():
+    """Drop cached entries when another service reports a user change.
+
+    Runs in a daemon thread with its own connection and an exclusive queue
+    bound to the user_events fanout exchange. Invalidation is best-effort;
+    the TTL bounds staleness if an event is missed.
+    """
+    def run():
+        while True:
+            try:
+                connection = pika.BlockingConnection(connection_parameters())
+                channel = connection.channel()
+                declare_user_events(channel)
+                queue = channel.queue_declare(queue='', exclusive=True).method.queue
+                channel.queue_bind(queue=queue, exchange=USER_EVENTS_EXCHANGE)
+
+                def callback(ch, method, properties, body):
+                    try:
+                        invalidate(json.loads(body)['user_id'])
+                    except (ValueError, KeyError):
+                        print('Discarding malformed user event')
+
+                channel.basic_consume(queue=queue, on_message_callback=callback, auto_ack=True)
+                channel.start_consuming()
+            except Exception as e:
+                print(f"User event listener disconnected, reconnecting: {str(e)}")
+                # Anything cached may have missed events while we were away
+                cache.clear()
+                time.sleep(5)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+def stats():
+    return cache.stats()